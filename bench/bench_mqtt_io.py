@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# Offline benchmark for mqtt_io.py.
+#
+# Runs the real MqttLightControl against a simulated RevPi: a generated
+# piCtory config.rsc and a plain file as process image (revpimodio2 falls
+# back to file I/O when the process image is not the piControl device), and
+# an in-process stand-in for the paho client instead of a broker. Each
+# size runs in its own subprocess so startup time and RSS are not skewed by
+# earlier runs. With --option runtime=asyncio the messages are delivered
+# from inside the bridge's event loop, as paho's socket reads would be.
+#
+# Usage:
+#   python bench/bench_mqtt_io.py [--sizes 10,100,500,2000] [--messages 5000]
+#                                 [--option batch_writes=true ...]
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+INPUT_COUNT = 16
+PWM_EVERY = 10
+GROUP_SIZE = 30
+# Byte offset of the first output in the simulated device. revpimodio2
+# expects inputs and outputs to be contiguous.
+OUTPUT_OFFSET = (INPUT_COUNT + 7) // 8
+
+
+def write_pictory(directory, output_count):
+    # One generic IO device: INPUT_COUNT digital inputs, then one bit output
+    # per switch, then one byte output per pwm switch.
+    inp = {}
+    for i in range(INPUT_COUNT):
+        inp[str(i)] = ["I_{}".format(i + 1), "0", "1", str(i // 8), True, "{:04d}".format(i), "", str(i % 8)]
+
+    out = {}
+    pwm_offset = OUTPUT_OFFSET + (output_count + 7) // 8
+    for i in range(output_count):
+        if i % PWM_EVERY == PWM_EVERY - 1:
+            out[str(i)] = ["O_{}".format(i + 1), "0", "8", str(pwm_offset + i // PWM_EVERY), True, "{:04d}".format(INPUT_COUNT + i), "", ""]
+        else:
+            out[str(i)] = ["O_{}".format(i + 1), "0", "1", str(OUTPUT_OFFSET + i // 8), True, "{:04d}".format(INPUT_COUNT + i), "", str(i % 8)]
+
+    device = {
+        "GUID": "00000000-0000-0000-0000-000000000000",
+        "id": "bench",
+        "type": "LEFT_RIGHT",
+        "productType": "0",
+        "position": "32",
+        "name": "bench",
+        "bmk": "bench",
+        "offset": 0,
+        "inp": inp,
+        "out": out,
+        "mem": {},
+        "extend": {},
+    }
+    configrsc = os.path.join(directory, 'config.rsc')
+    with open(configrsc, 'w') as f:
+        json.dump({"App": {"name": "mqttio bench"}, "Summary": {}, "Devices": [device]}, f)
+
+    procimg = os.path.join(directory, 'procimg')
+    with open(procimg, 'wb') as f:
+        f.write(bytes(4096))
+
+    return configrsc, procimg
+
+
+def write_config(directory, output_count, configrsc, procimg, options):
+    switches = []
+    for i in range(output_count):
+        switch = {
+            'id': 'bench_{}'.format(i),
+            'output_id': 'O_{}'.format(i + 1),
+            'group_topic': 'zigbee2mqtt/bench_{}/lights'.format(i // GROUP_SIZE),
+        }
+        if i % PWM_EVERY == PWM_EVERY - 1:
+            switch['type'] = 'pwm'
+        switches.append(switch)
+
+    config = {
+        'topic_prefix': 'bench/io',
+        'revpi_configrsc': configrsc,
+        'revpi_procimg': procimg,
+        'switches': switches,
+        'inputs': [{'id': 'bench_in_{}'.format(i), 'input_id': 'I_{}'.format(i + 1)} for i in range(INPUT_COUNT)],
+    }
+    config.update(options)
+
+    config_file = os.path.join(directory, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_file
+
+
+class LoopbackClient():
+    # Stand-in for paho.mqtt.client.Client: accepts the calls the bridge
+    # makes, counts them, and "connects" synchronously in loop_start().
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.published = 0
+        self.subscribed = 0
+        self.subscribe_packets = 0
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def will_set(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def disconnect(self):
+        pass
+
+    # Driven by the asyncio runtime instead of loop_start().
+    def loop_misc(self):
+        return 0
+
+    def want_write(self):
+        return False
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed += len(topic) if isinstance(topic, list) else 1
+        self.subscribe_packets += 1
+        return 0, self.subscribe_packets
+
+    def unsubscribe(self, topic):
+        return 0, 0
+
+
+def make_message(topic, payload, retain=False):
+    import paho.mqtt.client as mqtt
+    msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+    msg.payload = payload.encode('utf-8')
+    msg.retain = retain
+    return msg
+
+
+def make_load(bridge, count, seed=1):
+    # Mix of per-switch on/off/toggle, pwm percentages, JSON brightness and
+    # group commands. Every message carries the output it should change so
+    # the command-to-output latency can be sampled.
+    rng = random.Random(seed)
+    switches = bridge.switches
+    load = []
+    for _ in range(count):
+        switch = rng.choice(switches)
+        kind = rng.random()
+        if kind < 0.1:
+            msg = make_message(switch.group_command_topic, rng.choice(['ON', 'OFF']))
+        elif switch.is_pwm:
+            msg = make_message(switch.mqtt_command_topic, str(rng.randint(0, 100)))
+        elif kind < 0.3:
+            msg = make_message(switch.mqtt_command_topic, json.dumps({'state': 'on', 'brightness': rng.randint(0, 255)}))
+        else:
+            msg = make_message(switch.mqtt_command_topic, rng.choice(['on', 'off', 'toggle']))
+        load.append((msg, switch))
+    return load
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def output_layout(output_count):
+    # output_id -> (byte address, bit mask or None for byte outputs), the
+    # same layout write_pictory() generates.
+    layout = {}
+    pwm_offset = OUTPUT_OFFSET + (output_count + 7) // 8
+    for i in range(output_count):
+        if i % PWM_EVERY == PWM_EVERY - 1:
+            layout['O_{}'.format(i + 1)] = (pwm_offset + i // PWM_EVERY, None)
+        else:
+            layout['O_{}'.format(i + 1)] = (OUTPUT_OFFSET + i // 8, 1 << (i % 8))
+    return layout
+
+
+def output_written(fd, bridge, switch, layout):
+    # Whether the process image file holds the value the bridge has in its
+    # buffer, i.e. the autorefresh writer (or the asyncio cycle) flushed it.
+    # With command_queue the command may still be queued or being applied.
+    if len(bridge.commands):
+        return False
+    with bridge._pending_lock:
+        expected = bridge.get_output_value(switch)
+    address, mask = layout[switch.output_id]
+    value = os.pread(fd, 1, address)[0]
+    return mask is None and value == expected or mask is not None and bool(value & mask) == bool(expected)
+
+
+def wait_for_output(fd, bridge, switch, layout, timeout=1.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if output_written(fd, bridge, switch, layout):
+            return True
+        time.sleep(0.0002)
+    return False
+
+
+async def async_wait_for_output(fd, bridge, switch, layout, timeout=1.0):
+    # Yields to the event loop, which runs the process image cycle.
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if output_written(fd, bridge, switch, layout):
+            return True
+        await asyncio.sleep(0.0002)
+    return False
+
+
+def deliver(client, handler, load):
+    # Hot path: back-to-back delivery as fast as the network thread could.
+    timings = []
+    t_start = time.perf_counter()
+    for msg, switch in load:
+        t = time.perf_counter()
+        handler(client, None, msg)
+        timings.append(time.perf_counter() - t)
+    return timings, time.perf_counter() - t_start
+
+
+def run_one(output_count, message_count, options):
+    directory = tempfile.mkdtemp(prefix='mqttio-bench-')
+    try:
+        return run_in(directory, output_count, message_count, options)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_in(directory, output_count, message_count, options):
+    configrsc, procimg = write_pictory(directory, output_count)
+    config_file = write_config(directory, output_count, configrsc, procimg, options)
+    sys.argv = [sys.argv[0], config_file]
+
+    import mqtt_io
+    mqtt_io.logger.setLevel(os.environ.get('LOGLEVEL', 'WARNING'))
+
+    t0 = time.perf_counter()
+    bridge = mqtt_io.MqttLightControl()
+    client = LoopbackClient()
+    client.on_connect = bridge.mqtt_on_connect
+    client.on_message = bridge.mqtt_on_message
+    bridge.mqttclient = client
+    layout = output_layout(output_count)
+    fd = os.open(procimg, os.O_RDONLY)
+    handler = bridge.mqtt_on_message
+    # Command-to-output: paced commands, waiting for each one to hit the
+    # process image file.
+    latencies = []
+
+    if bridge.runtime == 'asyncio':
+        async def measure():
+            task = asyncio.create_task(bridge._run_asyncio())
+            while not bridge._running:
+                await asyncio.sleep(0.001)
+            client.on_connect(client, None, {}, 0)
+            startup = time.perf_counter() - t0
+            load = make_load(bridge, message_count)
+            timings, elapsed = deliver(client, handler, load)
+            missed = 0
+            for msg, switch in load[:min(200, len(load))]:
+                t = time.perf_counter()
+                handler(client, None, msg)
+                if await async_wait_for_output(fd, bridge, switch, layout):
+                    latencies.append(time.perf_counter() - t)
+                else:
+                    missed += 1
+            # The bridge's own SIGTERM handler ends _run_asyncio.
+            os.kill(os.getpid(), signal.SIGTERM)
+            await task
+            return startup, timings, elapsed, missed
+        startup, timings, elapsed, missed = asyncio.run(measure())
+    else:
+        bridge.start()
+        startup = time.perf_counter() - t0
+        load = make_load(bridge, message_count)
+        timings, elapsed = deliver(client, handler, load)
+        missed = 0
+        for msg, switch in load[:min(200, len(load))]:
+            t = time.perf_counter()
+            handler(client, None, msg)
+            if wait_for_output(fd, bridge, switch, layout):
+                latencies.append(time.perf_counter() - t)
+            else:
+                missed += 1
+    os.close(fd)
+
+    result = {
+        'switches': output_count,
+        'messages': message_count,
+        'startup_ms': startup * 1000,
+        'msgs_per_s': message_count / elapsed if elapsed else 0.0,
+        'handler_p50_us': percentile(timings, 50) * 1e6,
+        'handler_p99_us': percentile(timings, 99) * 1e6,
+        'output_p50_ms': percentile(latencies, 50) * 1000,
+        'output_p99_ms': percentile(latencies, 99) * 1000,
+        'output_missed': missed,
+        'published': client.published,
+        'subscribed': client.subscribed,
+        'subscribe_packets': client.subscribe_packets,
+        'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    bridge.rpi.exit()
+    return result
+
+
+def parse_options(values):
+    options = {}
+    for value in values:
+        key, _, raw = value.partition('=')
+        options[key] = yaml.safe_load(raw)
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark for mqtt_io.py')
+    parser.add_argument('--sizes', default='10,100,500,2000', help='comma separated switch counts')
+    parser.add_argument('--messages', type=int, default=5000, help='messages per size')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', help='extra config.yml setting (YAML value)')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per size')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_one(args.run, args.messages, parse_options(args.option))))
+        return
+
+    columns = [
+        ('switches', '{:>8}'), ('startup_ms', '{:>10.1f}'), ('msgs_per_s', '{:>10.0f}'),
+        ('handler_p50_us', '{:>14.1f}'), ('handler_p99_us', '{:>14.1f}'),
+        ('output_p50_ms', '{:>13.2f}'), ('output_p99_ms', '{:>13.2f}'),
+        ('published', '{:>9}'), ('rss_kb', '{:>8}'),
+    ]
+    if not args.json:
+        print(' '.join('{:>{}}'.format(name, len(fmt.format(0))) for name, fmt in columns))
+
+    for size in (int(x) for x in args.sizes.split(',')):
+        cmd = [sys.executable, os.path.abspath(__file__), '--run', str(size), '--messages', str(args.messages)]
+        for option in args.option:
+            cmd += ['--option', option]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(' '.join(fmt.format(result[name]) for name, fmt in columns))
+
+
+if __name__ == "__main__":
+    main()
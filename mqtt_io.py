@@ -12,13 +12,23 @@
 import os
 import sys
 import json
+import time
+import signal
+import asyncio
 import threading
 import yaml
 import revpimodio2
 import paho.mqtt.client as mqtt
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 import atexit
+import bisect
+import mmap
+import struct
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 logger = logging.getLogger()
 logHandler = logging.StreamHandler()
@@ -28,9 +38,640 @@ formatter = jsonlogger.JsonFormatter(
     rename_fields={"levelname": "level"},
 )
 logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
+if os.environ.get('LOG_ASYNC', '').lower() in ('1', 'true', 'yes'):
+    # JSON serialization and the stderr write happen on a listener thread;
+    # the paho network thread only enqueues the record.
+    logQueue = queue.SimpleQueue()
+    logListener = QueueListener(logQueue, logHandler)
+    logListener.start()
+    atexit.register(logListener.stop)
+    logger.addHandler(QueueHandler(logQueue))
+else:
+    logger.addHandler(logHandler)
 logger.setLevel(os.environ.get('LOGLEVEL', 'INFO'))
 
+# Role of a subscribed topic, resolved once in load_config.
+ROLE_COMMAND = 'command'
+ROLE_GROUP_COMMAND = 'group_command'
+ROLE_STATE_REPLAY = 'state_replay'
+ROLE_AVAILABILITY = 'availability'
+ROLE_HA_STATUS = 'ha_status'
+ROLE_BULK_COMMAND = 'bulk_command'
+
+# Commands the executor applies before looking at the queue again, so live
+# commands overtake a long run of retained replays. A message's group
+# fan-out is never split, so a batch can be larger.
+COMMAND_BATCH_SIZE = 32
+
+# Topic filters per SUBSCRIBE packet. Brokers cap the packet size, so very
+# large configs are split.
+SUBSCRIBE_CHUNK_SIZE = 200
+# Seconds between slices of the offline outbox flush.
+OUTBOX_FLUSH_TICK = 0.1
+
+# broadcast_state -> (group_state_topic payload, group_json_state_topic payload)
+GROUP_STATE_PAYLOADS = {state: (state.upper(), json.dumps({'state': state.upper()})) for state in ('on', 'off')}
+
+class Switch():
+    # Compiled form of a `switches:` entry. Everything the message hot path
+    # needs is a plain attribute; `config` keeps the validated dict.
+    __slots__ = (
+        'config', 'id', 'name', 'type', 'is_pwm', 'output_id', 'io', 'unique_id', 'min_brightness', 'transition',
+        'mqtt_config_topic', 'mqtt_command_topic', 'mqtt_state_topic', 'mqtt_availability_topic',
+        'group_topic', 'group_command_topic', 'group_state_topic', 'group_json_state_topic',
+        'group_availability_topic',
+    )
+
+    def __init__(self, config, group_availability_topic=None):
+        self.config = config
+        self.id = config['id']
+        self.name = config['name']
+        self.type = config['type']
+        self.is_pwm = config['type'] == 'pwm'
+        self.output_id = config['output_id']
+        # Bound to the revpimodio IO object once the process image is loaded.
+        self.io = None
+        self.unique_id = config['unique_id']
+        self.min_brightness = config['min_brightness']
+        self.transition = config['transition']
+        self.mqtt_config_topic = config['mqtt_config_topic']
+        self.mqtt_command_topic = config['mqtt_command_topic']
+        self.mqtt_state_topic = config['mqtt_state_topic']
+        self.mqtt_availability_topic = config['mqtt_availability_topic']
+        self.group_topic = config.get('group_topic')
+        self.group_command_topic = config.get('group_command_topic')
+        self.group_state_topic = config.get('group_state_topic')
+        self.group_json_state_topic = config.get('group_json_state_topic')
+        self.group_availability_topic = group_availability_topic
+
+class Rule():
+    # Compiled form of a `rules:` entry: what an edge on a RevPi input does
+    # to which switches, without going through the broker.
+    __slots__ = ('input_id', 'edge', 'action', 'step', 'debounce', 'switches')
+
+    def __init__(self, config, switches):
+        self.input_id = config['input_id']
+        self.edge = config['edge']
+        self.action = config['action']
+        self.step = config['step']
+        self.debounce = config['debounce']
+        self.switches = switches
+
+class TopicRoute():
+    # Prebuilt handler for one subscribed topic. `switches` are driven by any
+    # message on the topic, `retained_switches` additionally include switches
+    # whose state topic this is (only retained state is replayed).
+    __slots__ = ('role', 'handler', 'switches', 'retained_switches')
+
+    def __init__(self, role, handler):
+        self.role = role
+        self.handler = handler
+        self.switches = []
+        self.retained_switches = []
+
+class Histogram():
+    # Fixed-bucket latency histogram (seconds), Prometheus style.
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound label, cumulative count), ending with "+Inf".
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield str(le), total
+
+class Metrics():
+    # Counters are plain attributes bumped from the paho and revpimodio
+    # threads; a lost increment under contention is acceptable here.
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.messages_received = dict.fromkeys((ROLE_COMMAND, ROLE_GROUP_COMMAND, ROLE_STATE_REPLAY, ROLE_AVAILABILITY, ROLE_HA_STATUS, ROLE_BULK_COMMAND), 0)
+        self.unknown_topics = 0
+        self.parse_errors = 0
+        self.output_writes = 0
+        self.output_write_skips = 0
+        self.publishes = 0
+        self.publishes_suppressed = 0
+        self.publishes_deferred = 0
+        # Command queue backpressure: commands replaced by a newer one for
+        # the same output, commands dropped because the queue was full, and
+        # the largest depth seen.
+        self.commands_coalesced = 0
+        self.commands_dropped = 0
+        self.command_queue_high_water = 0
+        # Publishes the offline outbox had to drop to stay under its cap.
+        self.outbox_dropped = 0
+        # Outputs found changed in the process image by someone else.
+        self.outputs_drifted = 0
+        self.rules_fired = 0
+        # Seconds from starting the (re)connect until the broker acknowledged
+        # all subscriptions, for the most recent connect.
+        self.connect_ready_seconds = 0.0
+        # on_message entry -> value handed to the process image
+        self.command_write_latency = Histogram()
+
+    def mqtt_queue_length(self):
+        # paho keeps outgoing packets in a private deque; absent on
+        # stand-in clients.
+        out_packet = getattr(self.bridge.mqttclient, '_out_packet', None)
+        return len(out_packet) if out_packet is not None else 0
+
+    def as_dict(self):
+        histogram = self.command_write_latency
+        return {
+            'messages_received': dict(self.messages_received),
+            'unknown_topics': self.unknown_topics,
+            'parse_errors': self.parse_errors,
+            'output_writes': self.output_writes,
+            'output_write_skips': self.output_write_skips,
+            'publishes': self.publishes,
+            'publishes_suppressed': self.publishes_suppressed,
+            'publishes_deferred': self.publishes_deferred,
+            'mqtt_queue_length': self.mqtt_queue_length(),
+            'commands_coalesced': self.commands_coalesced,
+            'commands_dropped': self.commands_dropped,
+            'command_queue_length': len(self.bridge.commands),
+            'command_queue_high_water': self.command_queue_high_water,
+            'transitions_active': len(self.bridge.transitions),
+            'outbox_length': len(self.bridge._outbox),
+            'outbox_dropped': self.outbox_dropped,
+            'outputs_drifted': self.outputs_drifted,
+            'rules_fired': self.rules_fired,
+            'connect_ready_seconds': self.connect_ready_seconds,
+            'write_batch_size': self.bridge.write_batch_size,
+            'write_flush_latency_seconds': self.bridge.write_flush_latency,
+            'command_write_seconds': {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': dict(histogram.cumulative()),
+            },
+        }
+
+    def as_prometheus(self):
+        lines = ['# TYPE mqttio_messages_received_total counter']
+        for role, count in self.messages_received.items():
+            lines.append(f'mqttio_messages_received_total{{role="{role}"}} {count}')
+        for name, value in (('unknown_topics', self.unknown_topics), ('parse_errors', self.parse_errors),
+                            ('output_writes', self.output_writes), ('output_write_skips', self.output_write_skips),
+                            ('publishes', self.publishes), ('publishes_suppressed', self.publishes_suppressed),
+                            ('publishes_deferred', self.publishes_deferred), ('commands_coalesced', self.commands_coalesced),
+                            ('commands_dropped', self.commands_dropped), ('outbox_dropped', self.outbox_dropped),
+                            ('outputs_drifted', self.outputs_drifted), ('rules_fired', self.rules_fired)):
+            lines.append(f'# TYPE mqttio_{name}_total counter')
+            lines.append(f'mqttio_{name}_total {value}')
+        for name, value in (('mqtt_queue_length', self.mqtt_queue_length()), ('write_batch_size', self.bridge.write_batch_size),
+                            ('write_flush_latency_seconds', self.bridge.write_flush_latency),
+                            ('command_queue_length', len(self.bridge.commands)), ('command_queue_high_water', self.command_queue_high_water),
+                            ('transitions_active', len(self.bridge.transitions)), ('outbox_length', len(self.bridge._outbox)),
+                            ('connect_ready_seconds', self.connect_ready_seconds)):
+            lines.append(f'# TYPE mqttio_{name} gauge')
+            lines.append(f'mqttio_{name} {value}')
+        histogram = self.command_write_latency
+        lines.append('# TYPE mqttio_command_write_seconds histogram')
+        for le, count in histogram.cumulative():
+            lines.append(f'mqttio_command_write_seconds_bucket{{le="{le}"}} {count}')
+        lines.append(f'mqttio_command_write_seconds_sum {histogram.sum}')
+        lines.append(f'mqttio_command_write_seconds_count {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.metrics.as_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class IoWatch():
+    # Change/debounce state for one input IO under the asyncio runtime,
+    # which has no revpimodio mainloop to deliver reg_event callbacks.
+    __slots__ = ('io', 'callback', 'delay', 'value', 'timer')
+
+    def __init__(self, io, callback, delay):
+        self.io = io
+        self.callback = callback
+        self.delay = delay
+        self.value = None
+        self.timer = None
+
+class CommandQueue():
+    # Parsed switch commands waiting for the executor, at most one per
+    # output: a newer command for an output replaces the queued one. Live
+    # commands are handed out before retained replays. Filled from the
+    # network thread, drained by the executor. The outputs of one message
+    # (a group fan-out) are always handed out together, so with
+    # batch_writes they still switch in the same cycle.
+
+    def __init__(self, maxsize, metrics):
+        self.maxsize = maxsize
+        self.metrics = metrics
+        # output_id -> (switch, payload_state, payload_brightness,
+        # payload_transition, received), oldest first.
+        self.live = {}
+        self.replay = {}
+        # received (identifies the message) -> output_ids it still has queued
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.closed = False
+
+    def __len__(self):
+        return len(self.live) + len(self.replay)
+
+    def put(self, switch, payload_state, payload_brightness, payload_transition, received, live):
+        key = switch.output_id
+        with self.lock:
+            if self.closed:
+                return
+            if not live and key in self.live:
+                # A live command is newer than any retained state.
+                self.metrics.commands_coalesced += 1
+                return
+            previous = self.live.pop(key, None) or self.replay.pop(key, None)
+            if previous is not None:
+                self.metrics.commands_coalesced += 1
+                self._forget(previous[4], key)
+                if payload_state == 'toggle':
+                    payload_state, payload_brightness = self._toggle(previous)
+                    if payload_state is None:
+                        return
+            elif len(self) >= self.maxsize:
+                self.metrics.commands_dropped += 1
+                oldest = self.replay if self.replay else self.live
+                dropped = next(iter(oldest))
+                self._forget(oldest.pop(dropped)[4], dropped)
+
+            (self.live if live else self.replay)[key] = (switch, payload_state, payload_brightness, payload_transition, received)
+            self.messages.setdefault(received, set()).add(key)
+            depth = len(self)
+            if depth > self.metrics.command_queue_high_water:
+                self.metrics.command_queue_high_water = depth
+            self.ready.notify()
+
+    def _forget(self, received, key):
+        keys = self.messages.get(received)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.messages[received]
+
+    def _toggle(self, previous):
+        # A toggle relative to a command that has not run yet: two toggles
+        # cancel out, otherwise it becomes the opposite of the queued state.
+        switch, payload_state, payload_brightness = previous[:3]
+        if payload_state == 'toggle':
+            return None, None
+        try:
+            if payload_brightness is not None:
+                on = float(payload_brightness) >= switch.min_brightness
+            elif payload_state in ('on', 'off'):
+                on = payload_state == 'on'
+            else:
+                on = float(payload_state) > 0
+        except (TypeError, ValueError):
+            # The queued command was invalid and would have been ignored.
+            return 'toggle', None
+        return ('off' if on else 'on'), None
+
+    def take(self, limit, wait=False):
+        # Up to limit commands, live first, plus the rest of the messages
+        # they belong to. With wait, block until there is one; None once
+        # closed.
+        with self.lock:
+            while wait and not self.closed and not self.live and not self.replay:
+                self.ready.wait()
+            if self.closed:
+                return None
+            batch = []
+            for pending in (self.live, self.replay):
+                while pending and len(batch) < limit:
+                    command = pending.pop(next(iter(pending)))
+                    batch.append(command)
+                    for key in self.messages.pop(command[4], ()):
+                        rest = self.live.pop(key, None) or self.replay.pop(key, None)
+                        if rest is not None:
+                            batch.append(rest)
+            return batch
+
+    def discard(self, switches):
+        # Drop commands for switches a reload changed, removed or moved.
+        with self.lock:
+            for pending in (self.live, self.replay):
+                for key in [key for key, command in pending.items() if command[0] in switches]:
+                    self._forget(pending.pop(key)[4], key)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.live.clear()
+            self.replay.clear()
+            self.messages.clear()
+            self.ready.notify_all()
+
+class Transition():
+    # Linear fade of one pwm output from `start` to `target` (raw process
+    # image values) over `duration` seconds.
+    __slots__ = ('switch', 'start', 'target', 'started', 'duration', 'value')
+
+    def __init__(self, switch, start, target, started, duration):
+        self.switch = switch
+        self.start = start
+        self.target = target
+        self.started = started
+        self.duration = duration
+        self.value = start
+
+    def value_at(self, now):
+        if now >= self.started + self.duration:
+            return self.target
+        return round(self.start + (self.target - self.start) * (now - self.started) / self.duration)
+
+    def next_change(self):
+        # When the rounded value moves on from self.value.
+        step = 1 if self.target > self.start else -1
+        progress = (self.value + step / 2 - self.start) / (self.target - self.start)
+        return self.started + self.duration * min(1.0, max(0.0, progress))
+
+class TransitionWheel():
+    # Hashed timing wheel of running transitions with one slot per process
+    # image cycle. A transition waits in the slot of the cycle its output
+    # value next changes, so slow fades cost nothing on the cycles in
+    # between. advance() runs once per cycle; start() and cancel() come from
+    # the command path, so all three hold `lock`.
+
+    def __init__(self, resolution, size=256):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.tick = int(time.monotonic() / resolution)
+        # output_id -> running Transition
+        self.active = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.active)
+
+    def _schedule(self, transition, when):
+        tick = max(self.tick + 1, -int(-when // self.resolution))
+        self.slots[tick % self.size].append((tick, transition))
+
+    def start(self, transition):
+        with self.lock:
+            self.active[transition.switch.output_id] = transition
+            self._schedule(transition, transition.next_change())
+
+    def cancel(self, output_id):
+        # Superseded entries stay in their slot and are skipped when due.
+        if output_id in self.active:
+            with self.lock:
+                self.active.pop(output_id, None)
+
+    def advance(self, now):
+        # (switch, value) for every output that changes this cycle.
+        current = int(now / self.resolution)
+        first = max(self.tick + 1, current - self.size + 1)
+        self.tick = current
+        due = []
+        for tick in range(first, current + 1):
+            slot = self.slots[tick % self.size]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                (due if entry[0] <= current else keep).append(entry[1])
+            self.slots[tick % self.size] = keep
+
+        steps = []
+        for transition in due:
+            output_id = transition.switch.output_id
+            if self.active.get(output_id) is not transition:
+                continue
+            value = transition.value_at(now)
+            if value != transition.value:
+                transition.value = value
+                steps.append((transition.switch, value))
+            if value == transition.target:
+                del self.active[output_id]
+            else:
+                self._schedule(transition, transition.next_change())
+        return steps
+
+class StateSnapshot():
+    # Last commanded raw value of every output, memory-mapped: a header,
+    # then one fixed-size record per switch in config order. A record is an
+    # 8-byte key (switch id, output and type, so a rewired switch is not
+    # restored) and the value, UNKNOWN until the output is first commanded.
+    MAGIC = b'MQIOSNP1'
+    RECORD = struct.Struct('<8sH')
+    UNKNOWN = 0xFFFF
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        # switch id -> record offset
+        self.offsets = {}
+        # A reload replaces map and offsets while commands and the cycle
+        # thread use them.
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.flushed = time.monotonic()
+
+    @staticmethod
+    def key(switch):
+        return hashlib.blake2b('\0'.join((switch.id, switch.output_id, switch.type)).encode('utf-8'), digest_size=8).digest()
+
+    def load(self):
+        # key -> value of every known record in the existing file.
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        if not data.startswith(self.MAGIC):
+            return {}
+        values = {}
+        for key, value in self.RECORD.iter_unpack(data[len(self.MAGIC):len(data) - (len(data) - len(self.MAGIC)) % self.RECORD.size]):
+            if value != self.UNKNOWN:
+                values[key] = value
+        return values
+
+    def layout(self, switches, values):
+        # Map the file for this switch list, keeping the known values. A file
+        # already laid out for these switches is used in place; otherwise a
+        # new one replaces it atomically, so a power loss leaves either.
+        keys = [self.key(switch) for switch in switches]
+        data = self.MAGIC + b''.join(self.RECORD.pack(key, values.get(key, self.UNKNOWN)) for key in keys)
+        with self.lock:
+            self._close()
+            try:
+                with open(self.path, 'rb') as f:
+                    existing = f.read()
+            except FileNotFoundError:
+                existing = b''
+            in_place = (len(existing) == len(data) and existing.startswith(self.MAGIC)
+                        and [key for key, value in self.RECORD.iter_unpack(existing[len(self.MAGIC):])] == keys)
+            if not in_place:
+                tmp = self.path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            with open(self.path, 'r+b') as f:
+                self.map = mmap.mmap(f.fileno(), len(data))
+            if in_place and existing != data:
+                # Same switches, values changed by a reload.
+                self.map[:] = data
+                self.map.flush()
+            self.offsets = {switch.id: len(self.MAGIC) + i * self.RECORD.size for i, switch in enumerate(switches)}
+
+    def set(self, switch, value):
+        with self.lock:
+            offset = self.offsets.get(switch.id)
+            if offset is not None:
+                struct.pack_into('<H', self.map, offset + 8, value)
+                self.dirty = True
+
+    def flush(self, interval=0):
+        with self.lock:
+            self._flush(interval)
+
+    def _flush(self, interval=0):
+        if self.dirty and self.map is not None and time.monotonic() - self.flushed >= interval:
+            self.dirty = False
+            self.flushed = time.monotonic()
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.map is not None:
+            self._flush()
+            self.map.close()
+            self.map = None
+            self.offsets = {}
+
+class DriftCheck():
+    # Finds outputs changed behind our back (other programs sharing the
+    # process image, watchdog resets): one pread() of the bytes our outputs
+    # span, XORed as one integer against the values we wrote and masked to
+    # our outputs' bits. Only the differing bytes are looked at.
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()
+        self.start = 0
+        self.expected = bytearray()
+        self.mask = 0
+        # output_id -> (byte index, bit mask or None, length, byteorder)
+        self.outputs = {}
+        # byte index -> switches with bits in that byte
+        self.by_byte = {}
+        # output_id -> (actual, expected) of differences seen on the last
+        # check, to tell drift from a write still on its way to the image.
+        self.suspects = {}
+
+    def layout(self, switches):
+        with self.lock:
+            self.outputs = {}
+            self.by_byte = {}
+            self.suspects = {}
+            if not switches:
+                self.expected = bytearray()
+                self.mask = 0
+                return
+            self.start = min(switch.io.address for switch in switches)
+            end = max(switch.io.address + (1 if switch.io._bitshift else switch.io.length) for switch in switches)
+            self.expected = bytearray(end - self.start)
+            mask = bytearray(end - self.start)
+            for switch in switches:
+                io = switch.io
+                index = io.address - self.start
+                length = 1 if io._bitshift else io.length
+                self.outputs[switch.output_id] = (index, io._bitshift, length, io.byteorder)
+                for i in range(index, index + length):
+                    mask[i] |= io._bitshift or 0xFF
+                    self.by_byte.setdefault(i, []).append(switch)
+            self.mask = int.from_bytes(mask, 'little')
+        for switch in switches:
+            self.expect(switch, switch.io.value)
+
+    def expect(self, switch, value):
+        with self.lock:
+            output = self.outputs.get(switch.output_id)
+            if output is None:
+                return
+            index, bit, length, byteorder = output
+            if not bit:
+                self.expected[index:index + length] = int(value).to_bytes(length, byteorder)
+            elif value:
+                self.expected[index] |= bit
+            else:
+                self.expected[index] &= ~bit & 0xFF
+
+    def check(self):
+        # [(switch, actual value)] for outputs that differed from what we
+        # wrote, by the same values, on this and the previous check.
+        with self.lock:
+            if not self.outputs:
+                return []
+            actual = os.pread(self.fd, len(self.expected), self.start)
+            diff = (int.from_bytes(actual, 'little') ^ int.from_bytes(self.expected, 'little')) & self.mask
+            if not diff:
+                self.suspects = {}
+                return []
+            candidates = {}
+            while diff:
+                index = ((diff & -diff).bit_length() - 1) >> 3
+                diff &= ~(0xFF << (index * 8))
+                for switch in self.by_byte[index]:
+                    candidates[switch.output_id] = switch
+
+            suspects = {}
+            drifted = []
+            for output_id, switch in candidates.items():
+                index, bit, length, byteorder = self.outputs[output_id]
+                if bit:
+                    value = bool(actual[index] & bit)
+                    expected = bool(self.expected[index] & bit)
+                else:
+                    value = int.from_bytes(actual[index:index + length], byteorder)
+                    expected = int.from_bytes(self.expected[index:index + length], byteorder)
+                if value == expected:
+                    continue
+                if self.suspects.get(output_id) == (value, expected):
+                    drifted.append((switch, value))
+                else:
+                    suspects[output_id] = (value, expected)
+            self.suspects = suspects
+            return drifted
+
 class MqttLightControl():
     config_file = 'config.yml'
     topic_prefix = 'pi/io'
@@ -39,7 +680,13 @@ class MqttLightControl():
     mqtt_server_port = 1883
     mqtt_server_user = ""
     mqtt_server_password = ""
-    switch_mqtt_topic_map = {}
+    # piCtory configuration and process image. The defaults are the real
+    # hardware; point them at files to run against a simulated image.
+    revpi_configrsc = '/config.rsc'
+    revpi_procimg = None
+    # topic -> TopicRoute for every topic we subscribe to (except the
+    # discovery cleanup wildcards).
+    topic_routes = {}
     # group_command_topic -> per-attribute state topic. Populated for
     # conflict detection during load_config; the runtime mirror reads
     # the per-switch group_state_topic directly.
@@ -53,6 +700,62 @@ class MqttLightControl():
     # Populated from retained {"state":"online"|"offline"} on connect.
     z2m_group_online = {}
     unique_id_suffix = '_mqttio'
+    # Collect output changes and write them to the process image once per
+    # RevPi cycle instead of one write per command.
+    batch_writes = False
+    # Publish metrics as retained JSON on <topic_prefix>/bridge/metrics every
+    # metrics_interval seconds and/or serve them in Prometheus text format
+    # on metrics_port. 0 disables either.
+    metrics_interval = 0
+    metrics_port = 0
+    # 'threaded': paho network thread + revpimodio autorefresh/mainloop
+    # threads. 'asyncio': one event loop drives MQTT I/O, the process image
+    # cycle, input events and all timers.
+    runtime = 'threaded'
+    # Skip publishing a payload identical to the last one sent on the same
+    # topic. With publish_min_interval (seconds) a topic is also published at
+    # most that often; the latest payload within the interval is sent when
+    # it ends.
+    publish_dedup = True
+    publish_min_interval = 0
+    # Subscribe to <topic_prefix>/# instead of every switch topic under the
+    # prefix and route locally; topics outside the prefix (z2m groups, Home
+    # Assistant status) are still subscribed individually.
+    subscribe_wildcard = False
+
+    # Only parse and queue switch commands on the MQTT network thread and
+    # apply them from an executor (a thread, or the event loop with the
+    # asyncio runtime). At most command_queue_size outputs can have a
+    # command pending; beyond that the oldest is dropped.
+    command_queue = False
+    command_queue_size = 1000
+    # File keeping the last commanded value of every output (e.g. on a
+    # volume). Outputs are restored from it before MQTT connects; retained
+    # state replays are then only reconciled against it. Written through
+    # to disk at most every state_snapshot_flush_interval seconds.
+    state_snapshot = None
+    state_snapshot_flush_interval = 1
+    # 'json' or 'binary': also publish all output states as one retained
+    # message on <topic_prefix>/bridge/outputs (at most once per cycle) and
+    # accept {"<id>": state, ...} on <topic_prefix>/bridge/outputs/set.
+    aggregate_outputs = False
+    # While disconnected, publishes wait in an outbox holding the latest
+    # payload per topic, up to outbox_max_bytes (transient messages are
+    # dropped before retained ones, oldest first). After reconnecting it is
+    # sent at outbox_flush_rate messages per second.
+    outbox_max_bytes = 262144
+    outbox_flush_rate = 500
+    # Every this many process image cycles, read our outputs back from the
+    # process image and publish the real state of those another program
+    # (or a watchdog reset) changed. 0 disables the check.
+    drift_check_cycles = 0
+    # Re-read config.yml on SIGHUP and, with reload_poll_interval (seconds),
+    # whenever its modification time changes.
+    reload_poll_interval = 0
+
+    config_keys = ['topic_prefix', 'homeassistant_prefix', 'mqtt_server_ip', 'mqtt_server_port', 'mqtt_server_user', 'mqtt_server_password', 'switches', 'inputs', 'rules', 'unique_id_suffix', 'batch_writes', 'revpi_configrsc', 'revpi_procimg', 'metrics_interval', 'metrics_port', 'runtime', 'publish_dedup', 'publish_min_interval', 'subscribe_wildcard', 'reload_poll_interval', 'command_queue', 'command_queue_size', 'state_snapshot', 'state_snapshot_flush_interval', 'aggregate_outputs', 'outbox_max_bytes', 'outbox_flush_rate', 'drift_check_cycles']
+    # Settings a reload cannot apply to the running process.
+    restart_keys = ['topic_prefix', 'homeassistant_prefix', 'mqtt_server_ip', 'mqtt_server_port', 'mqtt_server_user', 'mqtt_server_password', 'revpi_configrsc', 'revpi_procimg', 'metrics_interval', 'metrics_port', 'runtime', 'reload_poll_interval', 'command_queue', 'command_queue_size', 'state_snapshot', 'aggregate_outputs', 'drift_check_cycles']
 
     default_switch = {
         'name': 'Switch',
@@ -60,7 +763,30 @@ class MqttLightControl():
         'md-icon': 'ceiling-light'
     }
 
+    default_input = {
+        'type': 'binary_sensor',
+        'debounce': 0,
+        'threshold': 1,
+    }
+
+    default_rule = {
+        'edge': 'rising',
+        'action': 'toggle',
+        'step': 10,
+        'debounce': 0,
+    }
+
     switches = []
+    inputs = []
+    rules = []
+    # input_id -> rules bound to it, and -> debounce (ms) of its watch.
+    rule_map = {}
+    rule_inputs = {}
+    # input_id -> input. Inputs are bound with reg_event and published on
+    # change only, from the revpimodio event loop.
+    input_io_map = {}
+    # input id -> last published value, replayed on (re)connect.
+    input_states = {}
 
     def __init__(self):
         logger.info("Init")
@@ -70,51 +796,104 @@ class MqttLightControl():
 
         self.load_config()
 
-        #Construct map for fast indexing
-        for switch in self.switches:
-            self.switch_mqtt_topic_map.setdefault(switch['mqtt_command_topic'], []).append(switch)
-            self.switch_mqtt_topic_map.setdefault(switch['mqtt_state_topic'], []).append(switch)
-            group_command_topic = switch.get('group_command_topic')
-            if group_command_topic:
-                self.switch_mqtt_topic_map.setdefault(group_command_topic, []).append(switch)
-
-            group_state_topic = switch.get('group_state_topic')
-            if group_state_topic:
-                if not group_command_topic:
-                    raise SyntaxError("Cannot load configuration: group_state_topic requires group_command_topic")
-                if group_command_topic in self.group_state_topic_map and self.group_state_topic_map[group_command_topic] != group_state_topic:
-                    raise SyntaxError(f"Cannot load configuration: conflicting group_state_topic values for group_command_topic {group_command_topic}")
-                self.group_state_topic_map[group_command_topic] = group_state_topic
-
-            group_json_state_topic = switch.get('group_json_state_topic')
-            if group_json_state_topic:
-                if not group_command_topic:
-                    raise SyntaxError("Cannot load configuration: group_json_state_topic requires group_command_topic")
-                if group_command_topic in self.group_json_state_topic_map and self.group_json_state_topic_map[group_command_topic] != group_json_state_topic:
-                    raise SyntaxError(f"Cannot load configuration: conflicting group_json_state_topic values for group_command_topic {group_command_topic}")
-                self.group_json_state_topic_map[group_command_topic] = group_json_state_topic
-
-            if group_state_topic or group_json_state_topic:
-                # z2m publishes group availability as retained
-                # {"state":"online"|"offline"} at <group_topic>/availability
-                # ("offline" for empty groups). Use it to decide whether we
-                # need to publish state ourselves. group_topic is guaranteed
-                # set here — load_config derives it from group_command_topic
-                # if not explicit.
-                avail_topic = switch['group_topic'] + '/availability'
-                self.group_availability_topic_map[group_command_topic] = avail_topic
-                self.z2m_group_online.setdefault(avail_topic, False)
+        # output_id -> (switch, state, new_value), latest value wins. Only
+        # used with batch_writes; flushed by the cycle thread.
+        self._pending_writes = {}
+        self._pending_since = None
+        # Reentrant so a whole command (e.g. a group fan-out) can hold it
+        # while queueing its writes, keeping the batch in one cycle.
+        self._pending_lock = threading.RLock()
+        # Set (under _pending_lock) to queue writes like batch_writes does,
+        # so a bulk command goes out in one process image write.
+        self._defer_writes = False
+        # Set on every output write; the aggregate topic is republished on
+        # the next cycle.
+        self._outputs_dirty = False
+        self.write_batch_size = 0
+        self.write_flush_latency = 0.0
+        self.metrics = Metrics(self)
+        self.commands = CommandQueue(self.command_queue_size, self.metrics)
+        self._commands_scheduled = False
+        # Event loop of the asyncio runtime, None when threaded.
+        self._loop = None
+        self._io_watches = []
+        self._stopped = False
+        # topic -> last payload handed to paho, and for publish_min_interval
+        # the last publish time and (payload, retain, due) of the trailing
+        # publish waiting for it, sent from rpi_on_cycle.
+        self._last_published = {}
+        self._publish_times = {}
+        self._publish_deferred = {}
+        self._publish_lock = threading.Lock()
+        # Offline outbox: topic -> (payload, retain) of publishes made while
+        # disconnected, latest wins, oldest first.
+        self._mqtt_connected = False
+        self._outbox = {}
+        self._outbox_bytes = 0
+        self._outbox_flushing = False
+        self._outbox_overflowed = False
+        # Connect-to-ready timing: when the (re)connect started and the mid
+        # of the last SUBSCRIBE sent from mqtt_on_connect.
+        self._connect_started = None
+        self._connected_at = None
+        self._ready_mid = None
+        # Discovery scans are numbered so a late fallback timer or sentinel
+        # cannot end a newer scan.
+        self._discovery_lock = threading.Lock()
+        self._discovery_token = 0
+        self._discovery_scan_started = None
+        # Set once inputs deliver events; watches added later fire their
+        # initial value themselves.
+        self._running = False
+        # Serializes reloads with each other and with (re)connects.
+        self._config_lock = threading.RLock()
 
         #RPI init
-        self.rpi = revpimodio2.RevPiModIO(autorefresh=True, shared_procimg=True, configrsc='/config.rsc')
-        self.rpi.handlesignalend(self.programend)
+        # The asyncio runtime drives the process image itself, so it must not
+        # start revpimodio's autorefresh thread.
+        self.rpi = revpimodio2.RevPiModIO(autorefresh=self.runtime == 'threaded', shared_procimg=True, configrsc=self.revpi_configrsc, procimg=self.revpi_procimg)
+        # Running pwm fades, stepped once per process image cycle.
+        self.transitions = TransitionWheel(self.rpi.cycletime / 1000)
+        if self.runtime == 'threaded':
+            self.rpi.handlesignalend(self.programend)
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_config())
+
+        for switch in self.switches:
+            switch.io = self.rpi.io[switch.output_id]
+
+        # Output ids restored from the snapshot; their retained replays are
+        # reconciled instead of applied.
+        self._restored = set()
+        self.snapshot = None
+        if self.state_snapshot:
+            self.snapshot = StateSnapshot(self.state_snapshot)
+            self._restore_snapshot()
+
+        # After the restore, so the restored values are what is expected.
+        self.drift = None
+        self._drift_countdown = self.drift_check_cycles
+        if self.drift_check_cycles:
+            self.drift = DriftCheck(os.open(self.rpi.procimg, os.O_RDONLY))
+            self.drift.layout(self.switches)
+
+        self.input_io_map = {}
+        for inp in self.inputs:
+            self.input_io_map[inp['input_id']] = inp
+            self.watch_io(inp['input_id'], self.rpi_on_input, inp['debounce'])
+        # input_id -> last value seen by the rules, to find edges.
+        self._rule_input_values = {}
+        for input_id, debounce in self.rule_inputs.items():
+            self.watch_io(input_id, self.rpi_on_rule_input, debounce)
 
         # TODO: Check whether PWM is enabled if type=pwm (see https://revpimodio.org/en/version-2-5-3-2/)
 
         #MQTT init
         self.mqttclient = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
         self.mqttclient.on_connect = self.mqtt_on_connect
+        self.mqttclient.on_disconnect = self.mqtt_on_disconnect
         self.mqttclient.on_message = self.mqtt_on_message
+        self.mqttclient.on_pre_connect = self.mqtt_on_pre_connect
+        self.mqttclient.on_subscribe = self.mqtt_on_subscribe
 
          #Register program end event
         atexit.register(self.programend)
@@ -127,20 +906,35 @@ class MqttLightControl():
         with open(self.config_file, 'r') as f:
             config = yaml.safe_load(f)
 
-        for key in ['topic_prefix', 'homeassistant_prefix', 'mqtt_server_ip', 'mqtt_server_port', 'mqtt_server_user', 'mqtt_server_password', 'switches', 'unique_id_suffix']:
+        for key in self.config_keys:
             try:
                 self.__setattr__(key, config[key])
             except KeyError:
                 pass
 
+        if self.runtime not in ('threaded', 'asyncio'):
+            raise SyntaxError("Cannot load configuration: runtime must be 'threaded' or 'asyncio'")
+
+        if self.aggregate_outputs not in (False, 'json', 'binary'):
+            raise SyntaxError("Cannot load configuration: aggregate_outputs must be 'json' or 'binary'")
+
         self.availability_topic = self.topic_prefix + '/bridge/state'
+        self.metrics_topic = self.topic_prefix + '/bridge/metrics'
+        self.aggregate_topic = self.topic_prefix + '/bridge/outputs'
+        self.aggregate_command_topic = self.aggregate_topic + '/set'
         self.homeassistant_status_topic = '{}/status'.format(self.homeassistant_prefix)
-        # Stale-config cleanup (approach A): switches publish under light/ and
-        # (for pwm dimmers) sensor/, so scan those two namespaces.
+        # Discovery scan (approach A): switches publish under switch/ or
+        # light/ and (for pwm dimmers) sensor/, inputs under binary_sensor/
+        # and sensor/, so scan those namespaces. The scan ends when our own
+        # non-retained message on the sentinel topic comes back, i.e. after
+        # the broker has delivered the retained burst for the wildcards.
         self.discovery_config_wildcards = [
+            '{}/switch/+/config'.format(self.homeassistant_prefix),
             '{}/light/+/config'.format(self.homeassistant_prefix),
             '{}/sensor/+/config'.format(self.homeassistant_prefix),
+            '{}/binary_sensor/+/config'.format(self.homeassistant_prefix),
         ]
+        self.discovery_sentinel_topic = self.topic_prefix + '/bridge/discovery_scan'
         self._discovery_scan = None
 
         for switch in self.switches:
@@ -161,7 +955,7 @@ class MqttLightControl():
                 switch['name'] = switch["id"]
 
             if switch['type'] == 'pwm':
-                component = 'sensor'
+                component = 'light'
             else:
                 component = switch['type']
 
@@ -173,6 +967,12 @@ class MqttLightControl():
                 except ValueError:
                     raise SyntaxError("Cannot load configuration: min_brightness must be a number")
 
+            # Default fade time in seconds for pwm commands without one.
+            try:
+                switch['transition'] = float(switch.get('transition', 0))
+            except ValueError:
+                raise SyntaxError("Cannot load configuration: transition must be a number")
+
             switch["mqtt_config_topic"] = "{}/{}/{}/config".format(self.homeassistant_prefix, component, switch["unique_id"])
             switch["mqtt_command_topic"] = "{}/{}/set".format(self.topic_prefix, switch["id"])
             switch["mqtt_state_topic"] = "{}/{}/state".format(self.topic_prefix, switch["id"])
@@ -194,57 +994,471 @@ class MqttLightControl():
                 cmd = switch['group_command_topic']
                 switch['group_topic'] = cmd[:-len('/set')] if cmd.endswith('/set') else cmd
 
+        for inp in self.inputs:
+            if not 'id' in inp:
+                raise SyntaxError('Cannot load configuration: input does not have ''id''')
+            if not 'input_id' in inp:
+                raise SyntaxError('Cannot load configuration: input does not have ''input_id''')
+
+            for k, v in self.default_input.items():
+                if not k in inp:
+                    inp[k] = v
+
+            if inp['type'] not in ('binary_sensor', 'sensor'):
+                raise SyntaxError("Cannot load configuration: input type must be 'binary_sensor' or 'sensor'")
+
+            try:
+                inp['debounce'] = int(inp['debounce'])
+                inp['threshold'] = float(inp['threshold'])
+            except ValueError:
+                raise SyntaxError("Cannot load configuration: input debounce and threshold must be numbers")
+            if inp['debounce'] < 0:
+                raise SyntaxError("Cannot load configuration: input debounce must not be negative")
+
+            if not 'unique_id' in inp:
+                inp['unique_id'] = inp["id"].replace('/', '_')
+            inp['unique_id'] += self.unique_id_suffix
+
+            if not 'name' in inp:
+                inp['name'] = inp["id"]
+
+            inp["mqtt_config_topic"] = "{}/{}/{}/config".format(self.homeassistant_prefix, inp['type'], inp["unique_id"])
+            inp["mqtt_state_topic"] = "{}/{}/state".format(self.topic_prefix, inp["id"])
+
+        self.switches = self._compile_switches(self.switches)
+        self.switch_ids = {switch.id: switch for switch in self.switches}
+        self.rule_map, self.rule_inputs = self._compile_rules(self.rules, self.switches)
+        self.topic_routes = self._compile_routes(self.switches)
+        self.discovery_configs = self._compile_discovery(self.switches, self.inputs)
+
+    def _compile_switches(self, switch_configs):
+        self.group_state_topic_map = {}
+        self.group_json_state_topic_map = {}
+        self.group_availability_topic_map = {}
+        # Built aside and swapped in whole: a reload must not expose a
+        # half-filled map to the message handlers, and keeps the known state
+        # of groups it still uses.
+        previous_online = self.z2m_group_online
+        z2m_group_online = {}
+        # z2m availability topic -> group state topics we mirror to
+        group_mirror_topics = {}
+
+        switches = []
+        for switch in switch_configs:
+            group_command_topic = switch.get('group_command_topic')
+
+            group_state_topic = switch.get('group_state_topic')
+            if group_state_topic:
+                if not group_command_topic:
+                    raise SyntaxError("Cannot load configuration: group_state_topic requires group_command_topic")
+                if group_command_topic in self.group_state_topic_map and self.group_state_topic_map[group_command_topic] != group_state_topic:
+                    raise SyntaxError(f"Cannot load configuration: conflicting group_state_topic values for group_command_topic {group_command_topic}")
+                self.group_state_topic_map[group_command_topic] = group_state_topic
+
+            group_json_state_topic = switch.get('group_json_state_topic')
+            if group_json_state_topic:
+                if not group_command_topic:
+                    raise SyntaxError("Cannot load configuration: group_json_state_topic requires group_command_topic")
+                if group_command_topic in self.group_json_state_topic_map and self.group_json_state_topic_map[group_command_topic] != group_json_state_topic:
+                    raise SyntaxError(f"Cannot load configuration: conflicting group_json_state_topic values for group_command_topic {group_command_topic}")
+                self.group_json_state_topic_map[group_command_topic] = group_json_state_topic
+
+            avail_topic = None
+            if group_state_topic or group_json_state_topic:
+                # z2m publishes group availability as retained
+                # {"state":"online"|"offline"} at <group_topic>/availability
+                # ("offline" for empty groups). Use it to decide whether we
+                # need to publish state ourselves. group_topic is guaranteed
+                # set here — load_config derives it from group_command_topic
+                # if not explicit.
+                avail_topic = switch['group_topic'] + '/availability'
+                self.group_availability_topic_map[group_command_topic] = avail_topic
+                z2m_group_online.setdefault(avail_topic, previous_online.get(avail_topic, False))
+                group_mirror_topics.setdefault(avail_topic, set()).update(t for t in (group_state_topic, group_json_state_topic) if t)
+
+            switches.append(Switch(switch, avail_topic))
+        self.z2m_group_online = z2m_group_online
+        self.group_mirror_topics = group_mirror_topics
+        return switches
+
+    def _compile_rules(self, rule_configs, switches):
+        switch_ids = {switch.id: switch for switch in switches}
+        rule_map = {}
+        rule_inputs = {}
+        for config in rule_configs:
+            if not 'input_id' in config:
+                raise SyntaxError('Cannot load configuration: rule does not have ''input_id''')
+            config = dict(self.default_rule, **config)
+            if config['edge'] not in ('rising', 'falling', 'both'):
+                raise SyntaxError("Cannot load configuration: rule edge must be 'rising', 'falling' or 'both'")
+            if config['action'] not in ('toggle', 'on', 'off', 'dim_up', 'dim_down'):
+                raise SyntaxError("Cannot load configuration: rule action must be 'toggle', 'on', 'off', 'dim_up' or 'dim_down'")
+            try:
+                config['step'] = float(config['step'])
+                config['debounce'] = int(config['debounce'])
+            except ValueError:
+                raise SyntaxError("Cannot load configuration: rule step and debounce must be numbers")
+            if config['debounce'] < 0:
+                raise SyntaxError("Cannot load configuration: rule debounce must not be negative")
+
+            # switch: <id>, switches: [<id>, ...] and/or group: <group_topic>
+            ids = ([config['switch']] if 'switch' in config else []) + list(config.get('switches', []))
+            targets = []
+            for id in ids:
+                if id not in switch_ids:
+                    raise SyntaxError(f"Cannot load configuration: rule for {config['input_id']} refers to unknown switch {id}")
+                targets.append(switch_ids[id])
+            if 'group' in config:
+                group = [switch for switch in switches if switch.group_topic == config['group']]
+                if not group:
+                    raise SyntaxError(f"Cannot load configuration: no switch has group_topic {config['group']}")
+                targets += [switch for switch in group if switch not in targets]
+            if not targets:
+                raise SyntaxError(f"Cannot load configuration: rule for {config['input_id']} has no switch, switches or group")
+            if config['action'].startswith('dim_') and not all(switch.is_pwm for switch in targets):
+                raise SyntaxError(f"Cannot load configuration: rule for {config['input_id']} dims a switch that is not pwm")
+
+            rule_map.setdefault(config['input_id'], []).append(Rule(config, tuple(targets)))
+            # One watch per input; the longest debounce of its rules wins.
+            rule_inputs[config['input_id']] = max(config['debounce'], rule_inputs.get(config['input_id'], 0))
+        return rule_map, rule_inputs
+
+    def _compile_routes(self, switches):
+        # Resolve every subscribed topic to its role and handler once, so
+        # mqtt_on_message is a single dict lookup. Registration order is the
+        # precedence if topics ever collide: HA status, z2m availability,
+        # then switch topics.
+        routes = {}
+
+        def route(topic, role, handler):
+            if topic not in routes:
+                routes[topic] = TopicRoute(role, handler)
+            return routes[topic]
+
+        route(self.homeassistant_status_topic, ROLE_HA_STATUS, self._handle_homeassistant_status)
+        for switch in switches:
+            if switch.group_availability_topic:
+                route(switch.group_availability_topic, ROLE_AVAILABILITY, self._handle_group_availability)
+        if self.aggregate_outputs:
+            route(self.aggregate_command_topic, ROLE_BULK_COMMAND, self._handle_bulk_command)
+
+        for switch in switches:
+            r = route(switch.mqtt_command_topic, ROLE_COMMAND, self._handle_switch_message)
+            r.switches.append(switch)
+            r.retained_switches.append(switch)
+            route(switch.mqtt_state_topic, ROLE_STATE_REPLAY, self._handle_switch_message).retained_switches.append(switch)
+            if switch.group_command_topic:
+                r = route(switch.group_command_topic, ROLE_GROUP_COMMAND, self._handle_switch_message)
+                r.switches.append(switch)
+                r.retained_switches.append(switch)
+
+        for r in routes.values():
+            r.switches = tuple(r.switches)
+            r.retained_switches = tuple(r.retained_switches)
+        return routes
+
+    def _compile_discovery(self, switches, inputs):
+        # config topic -> (serialized discovery payload, its hash). Built
+        # once; the scan compares the broker's retained copies by hash.
+        configs = {}
+        for switch in switches:
+            configs[switch.mqtt_config_topic] = self.discovery_config_for_switch(switch)
+        for inp in inputs:
+            configs[inp['mqtt_config_topic']] = self.discovery_config_for_input(inp)
+        return {topic: (payload, hash(payload)) for topic, payload in configs.items()}
+
+    def _restore_snapshot(self):
+        started = time.monotonic()
+        saved = self.snapshot.load()
+        restored = [(switch, saved[StateSnapshot.key(switch)]) for switch in self.switches if StateSnapshot.key(switch) in saved]
+        self.snapshot.layout(self.switches, saved)
+        if restored:
+            # All outputs in one process image write.
+            with self.rpi._imgwriter.lck_refresh:
+                for switch, value in restored:
+                    switch.io.value = value
+            if self.runtime == 'asyncio':
+                self.rpi.writeprocimg()
+        self._restored = {switch.output_id for switch, value in restored}
+        logger.info("Restored outputs from snapshot", extra={'outputs': len(restored), 'restore_ms': round((time.monotonic() - started) * 1000, 1)})
+
+    def _snapshot_values(self):
+        # key -> value to lay the snapshot out again after a reload.
+        return {StateSnapshot.key(switch): self.commanded_value(switch) for switch in self.switches}
+
+    def reload_config(self):
+        # Re-read the config file and apply only the difference: outputs,
+        # subscriptions and discovery of unchanged switches are not touched.
+        with self._config_lock:
+            try:
+                new = self._load_new_config()
+            except (OSError, yaml.YAMLError, SyntaxError, AttributeError, KeyError, TypeError, ValueError) as e:
+                logger.error(f"Config reload failed, keeping the current configuration: {e}")
+                return
+            changed = [key for key in self.restart_keys if getattr(new, key) != getattr(self, key)]
+            if changed:
+                logger.error("Config reload refused, these settings need a restart: " + ', '.join(changed))
+                return
+            try:
+                self._apply_config(new)
+            except Exception:
+                # Never from a signal handler or the poll thread into the
+                # process: that would end it and switch every output off.
+                logger.exception("Config reload failed while being applied, it may be partly in effect; restart to recover")
+
+    def _load_new_config(self):
+        # load_config on a bare instance, so a broken file leaves us untouched
+        # and nothing half-built is visible to the message handlers.
+        new = object.__new__(type(self))
+        new.config_file = self.config_file
+        new.z2m_group_online = self.z2m_group_online
+        new.load_config()
+        # Routes call back into this instance.
+        new.topic_routes = self._compile_routes(new.switches)
+        for switch in new.switches:
+            switch.io = self.rpi.io[switch.output_id]
+        for inp in new.inputs:
+            self.rpi.io[inp['input_id']]
+        for input_id in new.rule_inputs:
+            self.rpi.io[input_id]
+        # What paho would refuse half-way through _apply_config.
+        for topic in new.subscription_topics():
+            levels = topic.split('/')
+            if not topic or '#' in levels[:-1] or any(len(level) > 1 and ('+' in level or '#' in level) for level in levels):
+                raise ValueError(f"invalid topic filter {topic}")
+        published = [topic for switch in new.switches for topic in (switch.mqtt_config_topic, switch.mqtt_state_topic, switch.mqtt_availability_topic, switch.group_state_topic, switch.group_json_state_topic) if topic]
+        published += [topic for inp in new.inputs for topic in (inp['mqtt_config_topic'], inp['mqtt_state_topic'])]
+        for topic in published:
+            if '+' in topic or '#' in topic:
+                raise ValueError(f"wildcard in topic {topic}")
+        return new
+
+    def _apply_config(self, new):
+        old_switches = {switch.id: switch for switch in self.switches}
+        new_switches = {switch.id: switch for switch in new.switches}
+        unchanged = {id for id, switch in new_switches.items() if id in old_switches and old_switches[id].config == switch.config}
+        added = [switch for id, switch in new_switches.items() if id not in old_switches]
+        removed = [switch for id, switch in old_switches.items() if id not in new_switches]
+        # Changed switches keep their output value unless they moved to
+        # another output or changed between pwm and on/off.
+        moved = [(old_switches[id], switch) for id, switch in new_switches.items()
+                 if id in old_switches and id not in unchanged and (switch.output_id != old_switches[id].output_id or switch.is_pwm != old_switches[id].is_pwm)]
+        moved_states = []
+        for old, switch in moved:
+            value = self.get_output_value(old)
+            if switch.is_pwm:
+                moved_states.append((switch, round(value / 2.55) if old.is_pwm else (100 if value else 0)))
+            else:
+                moved_states.append((switch, 1 if value else 0))
+
+        old_inputs = {inp['id']: inp for inp in self.inputs}
+        new_inputs = {inp['id']: inp for inp in new.inputs}
+        # Removed or changed inputs are released, added or changed ones watched.
+        released_inputs = [inp for id, inp in old_inputs.items() if new_inputs.get(id) != inp]
+        watched_inputs = [inp for id, inp in new_inputs.items() if old_inputs.get(id) != inp]
+
+        old_topics = set(self.subscription_topics())
+        old_discovery = self.discovery_configs
+        # Queued commands hold the old Switch objects; only unchanged ones
+        # are still valid against the new group state.
+        self.commands.discard({switch for id, switch in old_switches.items() if id not in unchanged})
+
+        # Swap in the new configuration; routes last, so a message never
+        # reaches a switch whose group state is not in place yet.
+        for key in self.config_keys:
+            if key not in self.restart_keys and key not in ('switches', 'inputs'):
+                setattr(self, key, getattr(new, key))
+        self.group_state_topic_map = new.group_state_topic_map
+        self.group_json_state_topic_map = new.group_json_state_topic_map
+        self.group_availability_topic_map = new.group_availability_topic_map
+        self.z2m_group_online = new.z2m_group_online
+        self.group_mirror_topics = new.group_mirror_topics
+        self.switches = new.switches
+        self.switch_ids = new.switch_ids
+        old_rule_inputs = self.rule_inputs
+        self.rule_map = new.rule_map
+        self.rule_inputs = new.rule_inputs
+        self.discovery_configs = new.discovery_configs
+        self.topic_routes = new.topic_routes
+        # Switches were added, removed or reordered.
+        self._outputs_dirty = True
+        if self.drift is not None:
+            self.drift.layout(self.switches)
+
+        #Outputs: released ones off (as on program end), moved ones carry
+        #their value; added switches get theirs from the retained state.
+        for old in removed + [old for old, switch in moved]:
+            self.set_switch_state(old, 0)
+        for switch, state in moved_states:
+            self.set_switch_state(switch, state)
+        self.flush_writes()
+
+        for switch in removed:
+            self.mqtt_broadcast_switch_availability(switch, '')
+        for switch in added:
+            self.mqtt_broadcast_switch_availability(switch, '{"state": "online"}')
 
-    def configure_mqtt_for_switch(self, switch):
+        outdated = [topic for topic, config in self.discovery_configs.items() if old_discovery.get(topic) != config]
+        self.forget_published(outdated)
+        for topic in outdated:
+            self.mqtt_publish(topic, self.discovery_configs[topic][0], retain=True)
+        for topic in old_discovery:
+            if topic not in self.discovery_configs:
+                self.mqtt_publish(topic, '', retain=True)
+
+        if self.mqttclient.is_connected():
+            new_topics = self.subscription_topics()
+            self._subscribe([topic for topic in new_topics if topic not in old_topics])
+            stale_topics = old_topics.difference(new_topics)
+            if stale_topics:
+                self.mqttclient.unsubscribe(list(stale_topics))
+            if self.subscribe_wildcard and added:
+                # Already covered by the prefix wildcard, so nothing replays
+                # their retained topics. Subscribing to them directly does;
+                # the broker sends those before it handles the unsubscribe.
+                replay = [topic for switch in added for topic in (switch.mqtt_command_topic, switch.mqtt_state_topic)]
+                self._subscribe(replay)
+                self.mqttclient.unsubscribe(replay)
+
+        #Inputs: re-register the changed ones; watch_io publishes their
+        #current value.
+        for inp in released_inputs:
+            self.unwatch_io(inp['input_id'], self.rpi_on_input)
+            self.input_states.pop(inp['id'], None)
+        self.inputs = new.inputs
+        self.input_io_map = {inp['input_id']: inp for inp in self.inputs}
+        for inp in watched_inputs:
+            self.watch_io(inp['input_id'], self.rpi_on_input, inp['debounce'])
+        #Rules already use the new switches; only their watches change.
+        for input_id, debounce in old_rule_inputs.items():
+            if self.rule_inputs.get(input_id) != debounce:
+                self.unwatch_io(input_id, self.rpi_on_rule_input)
+                self._rule_input_values.pop(input_id, None)
+        for input_id, debounce in self.rule_inputs.items():
+            if old_rule_inputs.get(input_id) != debounce:
+                self.watch_io(input_id, self.rpi_on_rule_input, debounce)
+
+        if self.snapshot is not None:
+            self.snapshot.layout(self.switches, self._snapshot_values())
+
+        logger.info("Config reloaded", extra={'switches_added': len(added), 'switches_removed': len(removed),
+                                              'switches_changed': len(new_switches) - len(unchanged) - len(added),
+                                              'inputs_released': len(released_inputs), 'inputs_watched': len(watched_inputs),
+                                              'discovery_published': len(outdated)})
+
+    def _config_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _reload_if_modified(self, mtime):
+        current = self._config_mtime()
+        if current is not None and current != mtime:
+            logger.info("Config file changed, reloading")
+            self.reload_config()
+        return current
+
+    def discovery_config_for_switch(self, switch):
         switch_configuration = {
-            "name": switch["name"],
-            "command_topic": switch["mqtt_command_topic"],
+            "name": switch.name,
+            "command_topic": switch.mqtt_command_topic,
             "schema": "template",
             "command_on_template": "on",
             "command_off_template": "off",
-            "state_topic": switch["mqtt_state_topic"],
+            "state_topic": switch.mqtt_state_topic,
             "state_template": "{{ value_json.state }}",
             "availability": [
                 {'topic': self.availability_topic, 'value_template': '{{ value_json.state }}'},
-                {'topic': switch["mqtt_availability_topic"], 'value_template': '{{ value_json.state }}'},
+                {'topic': switch.mqtt_availability_topic, 'value_template': '{{ value_json.state }}'},
             ],
             "retain": False,
             "device": {
-                "identifiers": [switch["unique_id"]],
+                "identifiers": [switch.unique_id],
                 "manufacturer": "KUNBUS GmbH",
                 "model": "RevPi Digital IO",
-                "name": "RevPi "+switch['type'],
+                "name": "RevPi "+switch.type,
                 "sw_version": "mqttio"
             },
             "origin": {"name": "mqttio"},
-            "unique_id": switch["unique_id"]
+            "unique_id": switch.unique_id
         }
 
-        if switch['type'] == 'pwm':
-            switch_configuration['unit_of_measurement'] = '%'
+        if switch.is_pwm:
+            # Dimmable light: Home Assistant sends brightness 0-255 and an
+            # optional transition; the state topic holds on/off or percent.
+            switch_configuration.update({
+                "command_on_template": '{"state": "on"{% if brightness is defined %}, "brightness": {{ brightness }}{% endif %}'
+                                       '{% if transition is defined %}, "transition": {{ transition }}{% endif %}}',
+                "command_off_template": '{"state": "off"{% if transition is defined %}, "transition": {{ transition }}{% endif %}}',
+                "state_template": "{{ 'off' if value in ('off', '0', '0.0') else 'on' }}",
+                "brightness_template": "{{ 255 if value == 'on' else 0 if value == 'off' else ((value | float(0)) * 2.55) | round(0) | int }}",
+            })
+
+        return json.dumps(switch_configuration)
+
+    def discovery_config_for_input(self, inp):
+        input_configuration = {
+            "name": inp["name"],
+            "state_topic": inp["mqtt_state_topic"],
+            "value_template": "{{ value_json.state }}",
+            "availability": [
+                {'topic': self.availability_topic, 'value_template': '{{ value_json.state }}'},
+            ],
+            "device": {
+                "identifiers": [inp["unique_id"]],
+                "manufacturer": "KUNBUS GmbH",
+                "model": "RevPi Digital IO",
+                "name": "RevPi "+inp['type'],
+                "sw_version": "mqttio"
+            },
+            "origin": {"name": "mqttio"},
+            "unique_id": inp["unique_id"]
+        }
+
+        if inp['type'] == 'binary_sensor':
+            input_configuration['payload_on'] = 'on'
+            input_configuration['payload_off'] = 'off'
+        for key in ['device_class', 'unit_of_measurement']:
+            if key in inp:
+                input_configuration[key] = inp[key]
 
-        json_conf = json.dumps(switch_configuration)
-        logger.debug("Broadcasting homeassistant configuration for switch: " + switch["name"] + ":" + json_conf)
-        self.mqttclient.publish(switch["mqtt_config_topic"], payload=json_conf, qos=0, retain=True)
+        return json.dumps(input_configuration)
 
-    def _start_discovery_cleanup(self):
+    def _start_discovery_scan(self):
         # Approach A — broker is the source of truth for what discovery configs
-        # exist. Collect retained configs in our namespaces for a short window,
-        # then clear any that are ours (origin.name) but no longer desired.
-        self._discovery_scan = {}
-        for wildcard in self.discovery_config_wildcards:
-            self.mqttclient.subscribe(wildcard)
-        threading.Timer(3.0, self._finish_discovery_cleanup).start()
-
-    def _finish_discovery_cleanup(self):
-        scan, self._discovery_scan = self._discovery_scan, None
-        for wildcard in self.discovery_config_wildcards:
-            self.mqttclient.unsubscribe(wildcard)
-        if not scan:
-            return
-        desired = {switch['mqtt_config_topic'] for switch in self.switches}
+        # exist. Collect retained configs in our namespaces until the
+        # sentinel comes back (or a fallback timeout), then publish ours that
+        # are missing or differ and clear any that are ours (origin.name) but
+        # no longer desired.
+        with self._discovery_lock:
+            self._discovery_token += 1
+            token = str(self._discovery_token)
+            self._discovery_scan = {}
+            self._discovery_scan_started = time.monotonic()
+        self.mqttclient.subscribe([(wildcard, 0) for wildcard in self.discovery_config_wildcards] + [(self.discovery_sentinel_topic, 0)])
+        self.mqttclient.publish(self.discovery_sentinel_topic, payload=token, qos=0, retain=False)
+        self.call_later(3.0, lambda: self._finish_discovery_scan(token))
+
+    def _finish_discovery_scan(self, token):
+        with self._discovery_lock:
+            if token != str(self._discovery_token) or self._discovery_scan is None:
+                return
+            scan, self._discovery_scan = self._discovery_scan, None
+        self.mqttclient.unsubscribe(list(self.discovery_config_wildcards) + [self.discovery_sentinel_topic])
+
+        outdated = [topic for topic, (payload, payload_hash) in self.discovery_configs.items() if scan.pop(topic, None) != payload_hash]
+        # They may still be in the dedup cache from an earlier announce.
+        self.forget_published(outdated)
+        for topic in outdated:
+            payload = self.discovery_configs[topic][0]
+            logger.debug("Broadcasting homeassistant configuration", extra={'topic': topic, 'payload': payload})
+            self.mqtt_publish(topic, payload, retain=True)
+
+        # What is left in the scan is not (or no longer) desired.
+        cleared = 0
         for topic, payload in scan.items():
-            if topic in desired or not payload:
+            if not payload:
                 continue
             try:
                 conf = json.loads(payload)
@@ -254,9 +1468,17 @@ class MqttLightControl():
             if conf.get('origin', {}).get('name') != 'mqttio':
                 continue
             logger.info("Clearing stale discovery config: " + topic)
-            self.mqttclient.publish(topic, payload='', qos=0, retain=True)
+            self.mqtt_publish(topic, '', retain=True)
+            cleared += 1
+
+        logger.info("Discovery scan done", extra={'scan_ms': round((time.monotonic() - self._discovery_scan_started) * 1000, 1),
+                                                  'published': len(outdated), 'unchanged': len(self.discovery_configs) - len(outdated), 'cleared': cleared})
 
     def start(self):
+        if self.runtime == 'asyncio':
+            asyncio.run(self._run_asyncio())
+            return
+
         logger.info("starting")
 
         #MQTT startup
@@ -269,91 +1491,367 @@ class MqttLightControl():
         #RPI startup
         logger.info("Starting RPI client")
         self.rpi.mainloop(blocking=False)
+        self._running = True
+        threading.Thread(target=self._cycle_loop, name='mqttio-cycle', daemon=True).start()
+        if self.command_queue:
+            threading.Thread(target=self._command_loop, name='mqttio-commands', daemon=True).start()
         logger.info("RPI client started")
 
+        if self.metrics_interval:
+            threading.Thread(target=self._metrics_loop, name='mqttio-metrics', daemon=True).start()
+        if self.reload_poll_interval:
+            threading.Thread(target=self._reload_poll_loop, name='mqttio-reload', daemon=True).start()
+        self._start_metrics_server()
+
         logger.info("started")
 
-    def programend(self):
-        logger.info("stopping")
+    def _start_metrics_server(self):
+        # Read-only view of the counters, so it stays on its own thread in
+        # both runtimes.
+        if self.metrics_port:
+            MetricsRequestHandler.metrics = self.metrics
+            server = ThreadingHTTPServer(('', self.metrics_port), MetricsRequestHandler)
+            threading.Thread(target=server.serve_forever, name='mqttio-metrics-http', daemon=True).start()
+            logger.info(f"Serving metrics on port {self.metrics_port}")
 
-        for switch in self.switches:
-            self.set_switch_state(switch, 0)
-            self.mqtt_broadcast_switch_availability(switch, '')
+    async def _run_asyncio(self):
+        logger.info("starting")
+        self._loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(signum, stop.set)
+        self._loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+
+        #MQTT startup: paho only tells us about its socket, the loop does
+        #the reads and writes.
+        logger.info("Starting MQTT client")
+        client = self.mqttclient
+        client.on_socket_open = lambda client, userdata, sock: self._loop.add_reader(sock, client.loop_read)
+        client.on_socket_close = lambda client, userdata, sock: self._loop.remove_reader(sock)
+        client.on_socket_register_write = lambda client, userdata, sock: self._loop.add_writer(sock, client.loop_write)
+        client.on_socket_unregister_write = lambda client, userdata, sock: self._loop.remove_writer(sock)
+        # (Re)connects block the loop, so keep them short.
+        client.connect_timeout = 1.0
+        client.username_pw_set(self.mqtt_server_user, password=self.mqtt_server_password)
+        try:
+            client.connect(self.mqtt_server_ip, self.mqtt_server_port, 60)
+        except OSError as e:
+            logger.error(f"Could not connect to MQTT broker, retrying: {e}")
+        logger.info("MQTT client started")
 
-        self.mqttclient.disconnect()
-        self.rpi.exit()
-        logger.info("stopped")
+        #RPI startup
+        logger.info("Starting RPI client")
+        self.rpi.readprocimg()
+        for watch in self._io_watches:
+            watch.value = watch.io.value
+            watch.callback(watch.io.name, watch.value)
+        self._running = True
+        logger.info("RPI client started")
 
-    def mqtt_on_connect(self, client, userdata, flags, rc):
-        logger.info("MQTT client connected with result code "+str(rc))
+        tasks = [
+            asyncio.create_task(self._asyncio_cycle()),
+            asyncio.create_task(self._asyncio_mqtt_misc()),
+        ]
+        if self.metrics_interval:
+            tasks.append(asyncio.create_task(self._asyncio_metrics()))
+        if self.reload_poll_interval:
+            tasks.append(asyncio.create_task(self._asyncio_reload_poll()))
+        self._start_metrics_server()
+        logger.info("started")
 
-        #Configure MQTT for switches
-        for switch in self.switches:
-            self.configure_mqtt_for_switch(switch)
+        await stop.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.programend()
+
+    async def _asyncio_cycle(self):
+        # Same order as revpimodio's autorefresh writer: write our changed
+        # outputs, then read the whole shared image back.
+        cycletime = self.rpi.cycletime / 1000
+        next_cycle = self._loop.time()
+        while True:
+            self.rpi.writeprocimg()
+            self.rpi.readprocimg()
+            self._check_io_watches()
+            self.rpi_on_cycle()
+
+            next_cycle += cycletime
+            delay = next_cycle - self._loop.time()
+            if delay < 0:
+                next_cycle = self._loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    async def _asyncio_mqtt_misc(self):
+        # Keepalive, retries and reconnects that paho's loop_start thread
+        # would otherwise do.
+        backoff = 1
+        while True:
+            await asyncio.sleep(1)
+            if self.mqttclient.loop_misc() != mqtt.MQTT_ERR_NO_CONN:
+                backoff = 1
+                continue
+            try:
+                self.mqttclient.reconnect()
+                backoff = 1
+            except OSError as e:
+                logger.error(f"Could not connect to MQTT broker, retrying in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    async def _asyncio_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            self.mqtt_publish(self.metrics_topic, json.dumps(self.metrics.as_dict()), retain=True)
+
+    async def _asyncio_reload_poll(self):
+        mtime = self._config_mtime()
+        while True:
+            await asyncio.sleep(self.reload_poll_interval)
+            mtime = self._reload_if_modified(mtime)
+
+    def watch_io(self, io_name, callback, delay=0):
+        # Call callback(io_name, value) whenever the IO changes and then stays
+        # stable for delay ms, and once with the current value on start (or
+        # right away when already running).
+        io = self.rpi.io[io_name]
+        if self.runtime == 'asyncio':
+            watch = IoWatch(io, callback, delay)
+            self._io_watches.append(watch)
+            if self._running:
+                watch.value = io.value
+                callback(io.name, watch.value)
+        elif self._running:
+            # revpimodio refuses prefire once its mainloop runs.
+            io.reg_event(callback, delay=delay)
+            callback(io.name, io.value)
+        else:
+            # reg_event's delay only fires once the value has been stable that
+            # long; prefire delivers the initial value when the mainloop starts.
+            io.reg_event(callback, delay=delay, prefire=True)
+
+    def unwatch_io(self, io_name, callback):
+        io = self.rpi.io[io_name]
+        if self.runtime == 'asyncio':
+            for watch in [w for w in self._io_watches if w.io is io and w.callback == callback]:
+                if watch.timer is not None:
+                    watch.timer.cancel()
+                self._io_watches.remove(watch)
+        else:
+            io.unreg_event(callback)
 
-        #Broadcast current switch state to MQTT
-        for switch in self.switches:
-            self.mqtt_broadcast_switch_availability(switch, '{"state": "online"}')
+    def _check_io_watches(self):
+        for watch in self._io_watches:
+            value = watch.io.value
+            if value == watch.value:
+                continue
+            watch.value = value
+            if watch.timer is not None:
+                watch.timer.cancel()
+                watch.timer = None
+            if watch.delay:
+                watch.timer = self._loop.call_later(watch.delay / 1000, self._fire_io_watch, watch, value)
+            else:
+                watch.callback(watch.io.name, value)
+
+    def _fire_io_watch(self, watch, value):
+        watch.timer = None
+        watch.callback(watch.io.name, value)
+
+    def call_later(self, delay, callback):
+        # One-shot timer on whichever runtime we run; the returned object has
+        # cancel().
+        if self._loop is not None:
+            return self._loop.call_later(delay, callback)
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+        return timer
 
-        #Subsribe to MQTT switch updates
-        for topic in self.switch_mqtt_topic_map:
-            self.mqttclient.subscribe(topic)
+    def programend(self):
+        # Reached from revpimodio's signal handling, atexit and the asyncio
+        # shutdown; only the first call does the work.
+        if self._stopped:
+            return
+        self._stopped = True
+        logger.info("stopping")
+        self.commands.close()
 
-        #Subscribe to z2m group availability topics so we can defer to z2m
-        #when its groups have online members.
-        for avail_topic in set(self.group_availability_topic_map.values()):
-            self.mqttclient.subscribe(avail_topic)
+        # Waits for a command batch still being applied by the executor.
+        with self._pending_lock:
+            for switch in self.switches:
+                self.set_switch_state(switch, 0)
+                self.mqtt_broadcast_switch_availability(switch, '')
+        self.flush_writes()
+        if self.snapshot is not None:
+            self.snapshot.close()
 
-        #Re-announce discovery when Home Assistant restarts (birth message).
-        self.mqttclient.subscribe(self.homeassistant_status_topic)
+        self.mqttclient.disconnect()
+        if self._loop is not None:
+            # Nothing drives the process image or the MQTT socket anymore;
+            # push out the final outputs and the queued publishes ourselves.
+            self.rpi.writeprocimg()
+            while self.mqttclient.want_write() and self.mqttclient.loop_write() == mqtt.MQTT_ERR_SUCCESS:
+                pass
+        self.rpi.exit()
+        logger.info("stopped")
 
-        self.mqttclient.publish(self.availability_topic, payload='{"state": "online"}', qos=0, retain=True)
-        self.mqttclient.will_set(self.availability_topic, payload='{"state": "offline"}', qos=0, retain=True)
+    def subscription_topics(self):
+        # Topic filters for every route, collapsed into one wildcard for the
+        # routes under our prefix when subscribe_wildcard is set.
+        if not self.subscribe_wildcard:
+            return list(self.topic_routes)
+        prefix = self.topic_prefix + '/'
+        return [prefix + '#'] + [topic for topic in self.topic_routes if not topic.startswith(prefix)]
 
-        # Clear discovery configs left behind by past unique_ids.
-        self._start_discovery_cleanup()
+    def _subscribe(self, topics):
+        # Returns the mid of the last SUBSCRIBE packet.
+        mid = None
+        for i in range(0, len(topics), SUBSCRIBE_CHUNK_SIZE):
+            _, mid = self.mqttclient.subscribe([(topic, 0) for topic in topics[i:i + SUBSCRIBE_CHUNK_SIZE]])
+        return mid
 
-    def mqtt_on_message(self, client, userdata, msg):
-        payload = msg.payload.decode('utf-8').strip()
-        logger.debug("Received MQTT message on topic: " + msg.topic + ", payload: " + payload + ", retained: " + str(msg.retain))
+    def mqtt_on_pre_connect(self, client, userdata):
+        self._connect_started = time.monotonic()
 
-        # During a cleanup scan, collect retained discovery configs.
-        if self._discovery_scan is not None and msg.retain and msg.topic.endswith('/config'):
-            self._discovery_scan[msg.topic] = payload
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        logger.info("MQTT client connected with result code "+str(rc))
+        self._connected_at = time.monotonic()
+
+        # A reload must not swap routes between the subscribe and the
+        # announcements below.
+        with self._config_lock:
+            # The broker may have restarted without persistence: republish all.
+            with self._publish_lock:
+                self._last_published.clear()
+                self._publish_times.clear()
+                self._mqtt_connected = rc == 0
+                self._outbox_overflowed = False
+
+            #Subscribe to switch commands and retained state, z2m group
+            #availability (so we can defer to z2m when its groups have online
+            #members) and the Home Assistant birth message. Subscriptions go
+            #out first, a few hundred filters per packet, so commands are routed
+            #while the publishes below are still being sent; paho only queues
+            #those, they are written back to back without waiting for the broker.
+            topics = self.subscription_topics()
+            self._ready_mid = self._subscribe(topics)
+            logger.info("Subscribing", extra={'topics': len(topics), 'packets': (len(topics) + SUBSCRIBE_CHUNK_SIZE - 1) // SUBSCRIBE_CHUNK_SIZE})
+
+            #Discovery configs go out once the scan knows which are missing or
+            #outdated on the broker.
+            self._start_discovery_scan()
+
+            #Replay the inputs' last known state
+            for inp in self.inputs:
+                if inp['id'] in self.input_states:
+                    self.mqtt_broadcast_input_state(inp, self.input_states[inp['id']])
+
+            #Broadcast current switch state to MQTT
+            for switch in self.switches:
+                self.mqtt_broadcast_switch_availability(switch, '{"state": "online"}')
+
+            if self.aggregate_outputs:
+                self.mqtt_publish(self.aggregate_topic, self.aggregate_payload(), retain=True)
+
+            self.mqtt_publish(self.availability_topic, '{"state": "online"}', retain=True)
+            self.mqttclient.will_set(self.availability_topic, payload='{"state": "offline"}', qos=0, retain=True)
+
+            #What was published while we were offline; topics republished
+            #above already dropped out of the outbox.
+            with self._publish_lock:
+                flush = bool(self._outbox) and not self._outbox_flushing
+                self._outbox_flushing = self._outbox_flushing or flush
+            if flush:
+                logger.info("Flushing offline outbox", extra={'messages': len(self._outbox), 'bytes': self._outbox_bytes})
+                self._flush_outbox()
+
+    def mqtt_on_disconnect(self, client, userdata, rc):
+        logger.info("MQTT client disconnected with result code "+str(rc))
+        with self._publish_lock:
+            self._mqtt_connected = False
+
+    def mqtt_on_subscribe(self, client, userdata, mid, granted_qos):
+        if mid != self._ready_mid:
             return
+        self._ready_mid = None
+        now = time.monotonic()
+        started = self._connect_started or self._connected_at
+        self.metrics.connect_ready_seconds = now - started
+        logger.info("MQTT ready", extra={'connect_to_ready_ms': round((now - started) * 1000, 1),
+                                         'connack_to_ready_ms': round((now - self._connected_at) * 1000, 1)})
 
-        # Re-announce discovery when Home Assistant restarts (birth message).
-        if msg.topic == self.homeassistant_status_topic:
-            if payload == 'online':
-                logger.info("Home Assistant online — re-announcing discovery configs")
-                for switch in self.switches:
-                    self.configure_mqtt_for_switch(switch)
+    def mqtt_on_message(self, client, userdata, msg):
+        received = time.perf_counter()
+        route = self.topic_routes.get(msg.topic)
+        if route is None and self.subscribe_wildcard and msg.topic.startswith(self.topic_prefix + '/') and msg.topic != self.discovery_sentinel_topic:
+            # The prefix wildcard also delivers our own availability, input
+            # and bridge topics; dropped undecoded, since bridge/outputs may
+            # be binary.
             return
-
-        # Availability tracking branch: z2m publishes group availability at
-        # <group_root>/availability as retained JSON {"state":"online"|"offline"}.
-        # Anything other than positively-online (missing, parse error, "offline")
-        # is treated as not-online so we'll publish state ourselves.
-        if msg.topic in self.z2m_group_online:
-            try:
-                self.z2m_group_online[msg.topic] = json.loads(payload).get('state') == 'online'
-            except (json.decoder.JSONDecodeError, AttributeError):
-                self.z2m_group_online[msg.topic] = False
-            logger.debug(f"z2m group availability on {msg.topic}: {'online' if self.z2m_group_online[msg.topic] else 'not-online'}")
+        # Foreign payloads need not be UTF-8; handlers reject what they
+        # cannot parse.
+        payload = msg.payload.decode('utf-8', errors='replace').strip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received MQTT message", extra={'topic': msg.topic, 'payload': payload, 'retained': msg.retain})
+
+        if route is None:
+            # During a discovery scan, collect retained discovery configs:
+            # hashes of ours, payloads of the rest (to check their origin).
+            scan = self._discovery_scan
+            if scan is not None and msg.retain and msg.topic.endswith('/config'):
+                scan[msg.topic] = hash(payload) if msg.topic in self.discovery_configs else payload
+                return
+            if msg.topic == self.discovery_sentinel_topic:
+                self._finish_discovery_scan(payload)
+                return
+            self.metrics.unknown_topics += 1
+            logger.error("Could not find switch corresponding to topic " + msg.topic)
             return
 
+        self.metrics.messages_received[route.role] += 1
+        route.handler(route, msg, payload, received)
+
+    def _handle_homeassistant_status(self, route, msg, payload, received):
+        # Re-check discovery when Home Assistant restarts (birth message);
+        # only configs missing from or outdated on the broker are re-sent.
+        if payload == 'online':
+            logger.info("Home Assistant online — checking discovery configs")
+            self._start_discovery_scan()
+
+    def _handle_group_availability(self, route, msg, payload, received):
+        # z2m publishes group availability at <group_root>/availability as
+        # retained JSON {"state":"online"|"offline"}. Anything other than
+        # positively-online (missing, parse error, "offline") is treated as
+        # not-online so we'll publish state ourselves.
         try:
-            switch_group = self.switch_mqtt_topic_map[str(msg.topic)]
-            logger.debug("Found switch(es) matching MQTT message: " + ', '.join(s["name"] for s in switch_group))
-        except KeyError:
-            logger.error("Could not find switch corresponding to topic " + msg.topic)
+            online = json.loads(payload).get('state') == 'online'
+        except (json.decoder.JSONDecodeError, AttributeError):
+            online = False
+        if online != self.z2m_group_online.get(msg.topic, False):
+            # z2m publishes the group state while online, so what we last
+            # mirrored there says nothing about the topic anymore.
+            self.forget_published(self.group_mirror_topics.get(msg.topic, ()))
+        self.z2m_group_online[msg.topic] = online
+        logger.debug("z2m group availability changed", extra={'topic': msg.topic, 'online': self.z2m_group_online[msg.topic]})
+
+    def _handle_switch_message(self, route, msg, payload, received):
+        # Our own state topics are only replayed when retained; live
+        # messages there are the echo of our own publishes.
+        switch_group = route.retained_switches if msg.retain else route.switches
+        if not switch_group:
             return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Found switch(es) matching MQTT message", extra={'topic': msg.topic, 'switches': [s.id for s in switch_group]})
 
         payload_brightness = None
+        payload_transition = None
         if payload.startswith('{'):
             try:
                 payload_json = json.loads(payload)
             except json.decoder.JSONDecodeError:
+                self.metrics.parse_errors += 1
                 logger.error('Could not decode JSON sent on topic "{}": {}'.format(msg.topic, payload))
                 return
             try:
@@ -364,48 +1862,204 @@ class MqttLightControl():
                 payload_brightness = payload_json['brightness']
             except KeyError:
                 pass
+            if payload_json.get('transition') is not None:
+                try:
+                    payload_transition = max(0.0, float(payload_json['transition']))
+                except (TypeError, ValueError):
+                    self.metrics.parse_errors += 1
+                    logger.error(f'Could not parse transition in payload: {payload}')
+                    return
         else:
             payload_state = payload.lower()
 
         if payload_brightness is None and payload_state is None:
+            self.metrics.parse_errors += 1
             logger.error(f'Could not find state or brightness in payload: {payload}')
             return
 
-        broadcast_state = None
-        for s in switch_group:
-            if msg.topic == s['mqtt_state_topic'] and not msg.retain:
+        if msg.retain and self._restored:
+            # Outputs restored from the snapshot hold the last command; a
+            # retained replay only corrects the broker if it disagrees.
+            restored = tuple(s for s in switch_group if s.output_id in self._restored)
+            if restored:
+                self._apply_to_switch_group(restored, payload_state, payload_brightness, received, payload_transition, reconcile=True)
+                switch_group = tuple(s for s in switch_group if s.output_id not in self._restored)
+                if not switch_group:
+                    return
+
+        if self.command_queue:
+            self._queue_commands([(s, payload_state, payload_brightness, payload_transition) for s in switch_group], received, not msg.retain)
+            return
+
+        with self._pending_lock:
+            self._apply_to_switch_group(switch_group, payload_state, payload_brightness, received, payload_transition)
+
+    def _handle_bulk_command(self, route, msg, payload, received):
+        # {"<switch id>": state, ...} where state is what the switch's
+        # command topic takes (on/off/toggle, a percent for pwm, true/false)
+        # or an object with state, brightness and transition.
+        if msg.retain:
+            # A retained scene would override the outputs on every reconnect.
+            logger.warning(f"Ignoring retained message on {msg.topic}")
+            return
+        try:
+            payload_json = json.loads(payload)
+            if not isinstance(payload_json, dict):
+                raise ValueError('not an object')
+        except ValueError:
+            self.metrics.parse_errors += 1
+            logger.error('Could not decode JSON object sent on topic "{}": {}'.format(msg.topic, payload))
+            return
+
+        commands = []
+        for switch_id, value in payload_json.items():
+            switch = self.switch_ids.get(switch_id)
+            if switch is None:
+                self.metrics.parse_errors += 1
+                logger.error(f"Could not find switch {switch_id} in message on {msg.topic}")
+                continue
+            payload_brightness = None
+            payload_transition = None
+            if isinstance(value, dict):
+                payload_state = value.get('state')
+                payload_brightness = value.get('brightness')
+                if value.get('transition') is not None:
+                    try:
+                        payload_transition = max(0.0, float(value['transition']))
+                    except (TypeError, ValueError):
+                        self.metrics.parse_errors += 1
+                        logger.error(f"Could not parse transition for switch {switch_id}: {value}")
+                        continue
+            else:
+                payload_state = value
+            if isinstance(payload_state, bool) or isinstance(payload_state, (int, float)) and not switch.is_pwm:
+                payload_state = 'on' if payload_state else 'off'
+            elif payload_state is not None:
+                payload_state = str(payload_state).lower()
+            if payload_state is None and payload_brightness is None:
+                self.metrics.parse_errors += 1
+                logger.error(f"Could not find state or brightness for switch {switch_id}: {value}")
                 continue
+            commands.append((switch, payload_state, payload_brightness, payload_transition))
+        if not commands:
+            return
 
+        if self.command_queue:
+            # Behind whatever the executor already took, as one unit.
+            self._queue_commands(commands, received, True)
+            return
+        with self._pending_lock:
+            self._defer_writes = True
+            try:
+                for switch, payload_state, payload_brightness, payload_transition in commands:
+                    self._apply_to_switch_group((switch,), payload_state, payload_brightness, received, payload_transition)
+            finally:
+                self._defer_writes = False
+        if not self.batch_writes:
+            self.flush_writes()
+
+    def _queue_commands(self, commands, received, live):
+        # (switch, payload_state, payload_brightness, payload_transition)
+        # from one message; sharing received, they are taken as one unit.
+        for switch, payload_state, payload_brightness, payload_transition in commands:
+            self.commands.put(switch, payload_state, payload_brightness, payload_transition, received, live)
+        if self._loop is not None and not self._commands_scheduled:
+            self._commands_scheduled = True
+            self._loop.call_soon(self._drain_commands)
+
+    def _command_loop(self):
+        while True:
+            batch = self.commands.take(COMMAND_BATCH_SIZE, wait=True)
+            if batch is None:
+                return
+            self._execute_commands(batch)
+
+    def _drain_commands(self):
+        # asyncio executor: one batch per loop iteration, so socket reads,
+        # keepalives and the process image cycle run in between.
+        batch = self.commands.take(COMMAND_BATCH_SIZE)
+        if batch:
+            self._execute_commands(batch)
+        if len(self.commands) and not self._stopped:
+            self._loop.call_soon(self._drain_commands)
+        else:
+            self._commands_scheduled = False
+
+    def _execute_commands(self, batch):
+        # One lock hold per batch, its writes queued and flushed together,
+        # puts a whole message (group fan-out, bulk set) in one process
+        # image write.
+        with self._pending_lock:
+            self._defer_writes = True
+            try:
+                for switch, payload_state, payload_brightness, payload_transition, received in batch:
+                    self._apply_to_switch_group((switch,), payload_state, payload_brightness, received, payload_transition)
+            except Exception:
+                # The executor must outlive one bad batch, or nothing queued
+                # after it is ever applied.
+                logger.exception("Failed to apply queued commands")
+            finally:
+                self._defer_writes = False
+        if not self.batch_writes:
+            self.flush_writes()
+
+    def _apply_to_switch_group(self, switch_group, payload_state, payload_brightness, received=None, payload_transition=None, reconcile=False):
+        z2m_group_online = self.z2m_group_online
+        publish = self.mqtt_publish
+        for s in switch_group:
             broadcast_state = payload_state
             state = None
             if payload_state == "toggle":
-                state = not self.rpi.io[s["output_id"]].value
+                # Against where a fade is headed, not its current level.
+                state = not self.commanded_value(s)
                 broadcast_state = 'on' if state else 'off'
             elif payload_state == "on":
                 state = True
             elif payload_state == "off":
                 state = False
-            elif s['type'] == 'pwm':
+            elif payload_brightness is not None:
+                # Decided by the brightness below.
+                pass
+            elif s.is_pwm:
                 try:
                     state = float(payload_state)
                     if state < 0 or state > 100:
                         raise ValueError('pwm command must be percent value between 0 and 100')
                 except ValueError:
+                    self.metrics.parse_errors += 1
                     logger.error("Setting output state to " + payload_state + " not supported for pwm type, must be percent: 0 <= x <= 100")
                     continue
-            elif payload_brightness is None:
+            else:
+                self.metrics.parse_errors += 1
                 logger.error("Setting output state to " + payload_state + " not supported for switch type")
                 continue
-            
-            if state != 'off' and payload_brightness is not None:
+
+            if payload_brightness is not None and not (s.is_pwm and payload_state == "off"):
                 try:
-                    state = float(payload_brightness) >= s['min_brightness']
-                except ValueError:
+                    brightness = float(payload_brightness)
+                except (TypeError, ValueError):
+                    self.metrics.parse_errors += 1
                     logger.error("Cannot apply brightness {}, brightness must be a number".format(payload_brightness))
                     continue
-                broadcast_state = 'on' if state else 'off'
+                if s.is_pwm:
+                    # 0-255 as sent by Home Assistant and z2m.
+                    state = min(100.0, max(0.0, brightness / 2.55))
+                    broadcast_state = str(round(state))
+                else:
+                    state = brightness >= s.min_brightness
+                    broadcast_state = 'on' if state else 'off'
+
+            if reconcile:
+                value = self.commanded_value(s)
+                if self.output_value(s, state) != value:
+                    self.mqtt_broadcast_state(s, self.state_payload(s, value))
+                continue
 
-            self.set_switch_state(s, state)
+            transition = s.transition if payload_transition is None else payload_transition
+            if s.is_pwm and transition > 0:
+                self.start_transition(s, state, transition)
+            else:
+                self.set_switch_state(s, state, received)
             self.mqtt_broadcast_state(s, broadcast_state)
 
             # Mirror to the z2m-shaped group topics for any state change,
@@ -414,51 +2068,366 @@ class MqttLightControl():
             # (the per-relay set); without this mirror, downstream listeners
             # of group_state_topic see stale state until the next button
             # press goes through group_command_topic.
-            group_state_topic = s.get('group_state_topic')
-            group_json_state_topic = s.get('group_json_state_topic')
-            if not (group_state_topic or group_json_state_topic):
-                continue
-            avail_topic = self.group_availability_topic_map.get(s.get('group_command_topic'))
-            # Defer to z2m only when its group availability is positively "online".
-            # Missing/offline/parse-error → publish ourselves.
-            if avail_topic and self.z2m_group_online.get(avail_topic, False):
+            # group_availability_topic is set iff either group state topic
+            # is. Defer to z2m only when its group availability is
+            # positively "online"; missing/offline/parse-error → publish
+            # ourselves.
+            avail_topic = s.group_availability_topic
+            if avail_topic is None or z2m_group_online.get(avail_topic, False):
                 continue
-            if group_state_topic:
-                self.mqttclient.publish(
-                    group_state_topic,
-                    payload=broadcast_state.upper(),
-                    qos=0,
-                    retain=False,
-                )
-            if group_json_state_topic:
-                self.mqttclient.publish(
-                    group_json_state_topic,
-                    payload=json.dumps({'state': broadcast_state.upper()}),
-                    qos=0,
-                    retain=False,
-                )
-
-    def set_switch_state(self, switch, state):
-        if switch['type'] == 'pwm':
+            # z2m groups are ON/OFF; the percent of a pwm switch stays on
+            # its own state topic.
+            payloads = GROUP_STATE_PAYLOADS.get(('on' if state else 'off') if s.is_pwm else broadcast_state)
+            if payloads is None:
+                payloads = (broadcast_state.upper(), json.dumps({'state': broadcast_state.upper()}))
+            if s.group_state_topic:
+                publish(s.group_state_topic, payloads[0])
+            if s.group_json_state_topic:
+                publish(s.group_json_state_topic, payloads[1])
+
+    def set_switch_state(self, switch, state, received=None):
+        # received: perf_counter() of the MQTT message that caused this,
+        # for the command-to-write latency histogram.
+        if switch.is_pwm:
+            # A direct command ends a running fade.
+            self.transitions.cancel(switch.output_id)
+            if state == True:
+                state = 100
+            if state == False:
+                state = 0
+        new_value = self.output_value(switch, state)
+        # Program end switches everything off; the snapshot keeps what was
+        # commanded so a restart restores it.
+        if self.snapshot is not None and not self._stopped:
+            self.snapshot.set(switch, new_value)
+
+        if self.batch_writes or self._defer_writes:
+            with self._pending_lock:
+                if not self._pending_writes:
+                    self._pending_since = time.monotonic()
+                self._pending_writes[switch.output_id] = (switch, state, new_value, received)
+            return
+
+        self._write_output(switch, state, new_value, received)
+
+    def output_value(self, switch, state):
+        # Process image value for a state: percent for pwm, truthy otherwise.
+        if switch.is_pwm:
             if state == True:
                 state = 100
             if state == False:
                 state = 0
-            new_value = round(state*2.55)
+            return round(state*2.55)
+        return 1 if state else 0
+
+    def state_payload(self, switch, value):
+        # State topic payload for a process image value.
+        if not switch.is_pwm:
+            return 'on' if value else 'off'
+        if value == 0:
+            return 'off'
+        return str(round(value / 2.55))
+
+    def start_transition(self, switch, state, duration):
+        # Fade a pwm output from its current value to state (percent) over
+        # duration seconds; the steps are written by rpi_on_cycle.
+        if state == True:
+            state = 100
+        if state == False:
+            state = 0
+        target = self.output_value(switch, state)
+        if self.snapshot is not None and not self._stopped:
+            self.snapshot.set(switch, target)
+        self.transitions.cancel(switch.output_id)
+        start = self.get_output_value(switch)
+        if start == target:
+            return
+        logger.info("Fading %s (%s) to %s over %ss", switch.name, switch.output_id, state, duration, extra={'switch': switch.id, 'output_id': switch.output_id, 'state': state, 'transition': duration})
+        self.transitions.start(Transition(switch, start, target, time.monotonic(), duration))
+
+    def _advance_transitions(self):
+        if not self.transitions.active:
+            return
+        # Holding the wheel lock while writing keeps a command that cancels
+        # a fade from being overwritten by that fade's last step.
+        with self.transitions.lock:
+            steps = self.transitions.advance(time.monotonic())
+            if not steps:
+                return
+            with self.rpi._imgwriter.lck_refresh:
+                for switch, value in steps:
+                    switch.io.value = value
+            if self.drift is not None:
+                for switch, value in steps:
+                    self.drift.expect(switch, value)
+        self._outputs_dirty = True
+        self.metrics.output_writes += len(steps)
+
+    def _write_output(self, switch, state, new_value, received=None):
+        if self.drift is not None:
+            self.drift.expect(switch, new_value)
+        if switch.io.value == new_value:
+            self.metrics.output_write_skips += 1
+            return
+        logger.info("Setting %s (%s) to %s", switch.name, switch.output_id, state, extra={'switch': switch.id, 'output_id': switch.output_id, 'state': state})
+        switch.io.value = new_value
+        self._outputs_dirty = True
+        self.metrics.output_writes += 1
+        if received is not None:
+            self.metrics.command_write_latency.observe(time.perf_counter() - received)
+
+    def commanded_value(self, switch):
+        # Where the output is headed: the target of a running fade, else
+        # the output value.
+        transition = self.transitions.active.get(switch.output_id)
+        if transition is not None:
+            return transition.target
+        return self.get_output_value(switch)
+
+    def get_output_value(self, switch):
+        # Pending batched writes are the value the output is about to have.
+        pending = self._pending_writes.get(switch.output_id)
+        if pending is not None:
+            return pending[2]
+        return switch.io.value
+
+    def flush_writes(self):
+        with self._pending_lock:
+            if not self._pending_writes:
+                return
+            pending, self._pending_writes = self._pending_writes, {}
+            since = self._pending_since
+
+        # Hold off the autorefresh writer (the same lock revpimodio's own
+        # cycleloop uses) so every queued output goes out in the same cycle.
+        with self.rpi._imgwriter.lck_refresh:
+            for switch, state, new_value, received in pending.values():
+                self._write_output(switch, state, new_value, received)
+
+        self.write_batch_size = len(pending)
+        self.write_flush_latency = time.monotonic() - since
+        logger.debug("Flushed outputs to process image", extra={'batch_size': self.write_batch_size, 'flush_latency': self.write_flush_latency})
+
+    def _cycle_loop(self):
+        # mainloop has no per-cycle hook, so follow the autorefresh writer:
+        # it sets newdata after every process image sync.
+        newdata = self.rpi._imgwriter.newdata
+        while not self.rpi.exitsignal.is_set():
+            if not newdata.wait(1.0):
+                continue
+            newdata.clear()
+            self.rpi_on_cycle()
+
+    def rpi_on_cycle(self):
+        # Once per process image cycle, from the cycle thread or the asyncio
+        # cycle task.
+        self._advance_transitions()
+        self.flush_writes()
+        if self._publish_deferred:
+            self._publish_trailing()
+        if self.drift is not None:
+            self._drift_countdown -= 1
+            if self._drift_countdown <= 0:
+                self._drift_countdown = self.drift_check_cycles
+                self._correct_drift()
+        if self.aggregate_outputs and self._outputs_dirty:
+            self._outputs_dirty = False
+            self.mqtt_publish(self.aggregate_topic, self.aggregate_payload(), retain=True)
+        if self.snapshot is not None:
+            self.snapshot.flush(self.state_snapshot_flush_interval)
+
+    def _correct_drift(self):
+        for switch, value in self.drift.check():
+            self.drift.expect(switch, value)
+            self.metrics.outputs_drifted += 1
+            logger.warning("%s (%s) was changed outside the bridge to %s", switch.name, switch.output_id, value, extra={'switch': switch.id, 'output_id': switch.output_id, 'value': value})
+            # Don't fight the other writer with the rest of a fade.
+            self.transitions.cancel(switch.output_id)
+            if self.snapshot is not None:
+                self.snapshot.set(switch, value)
+            self._outputs_dirty = True
+            self.mqtt_broadcast_state(switch, self.state_payload(switch, value))
+
+    def aggregate_payload(self):
+        # All outputs in config order. json: {"<id>": 1/0, or percent for
+        # pwm}. binary: one bit per switch (set when the output is not 0,
+        # LSB first), then one byte per pwm switch with its raw value.
+        switches = self.switches
+        values = [switch.io.value for switch in switches]
+        if self.aggregate_outputs == 'json':
+            return json.dumps({switch.id: round(value / 2.55) if switch.is_pwm else int(bool(value)) for switch, value in zip(switches, values)}, separators=(',', ':'))
+        bits = bytearray((len(values) + 7) // 8)
+        for i, value in enumerate(values):
+            if value:
+                bits[i >> 3] |= 1 << (i & 7)
+        return bytes(bits) + bytes(value for switch, value in zip(switches, values) if switch.is_pwm)
+
+    def _metrics_loop(self):
+        while not self.rpi.exitsignal.wait(self.metrics_interval):
+            self.mqtt_publish(self.metrics_topic, json.dumps(self.metrics.as_dict()), retain=True)
+
+    def _reload_poll_loop(self):
+        mtime = self._config_mtime()
+        while not self.rpi.exitsignal.wait(self.reload_poll_interval):
+            mtime = self._reload_if_modified(mtime)
+
+    def rpi_on_input(self, ioname, iovalue):
+        # Runs in the revpimodio event loop, once per (debounced) change.
+        inp = self.input_io_map.get(ioname)
+        if inp is None:
+            # Removed by a reload while the event was pending.
+            return
+        if inp['type'] == 'binary_sensor':
+            value = 'on' if iovalue else 'off'
+            if self.input_states.get(inp['id']) == value:
+                return
         else:
-            new_value = 1 if state else 0
+            value = iovalue
+            last = self.input_states.get(inp['id'])
+            if last is not None and abs(value - last) < inp['threshold']:
+                return
+
+        self.input_states[inp['id']] = value
+        self.mqtt_broadcast_input_state(inp, value)
+
+    def rpi_on_rule_input(self, ioname, iovalue):
+        # Same context as rpi_on_input: the revpimodio event loop, or the
+        # asyncio cycle. The first call (the value on start) only records it.
+        last = self._rule_input_values.get(ioname)
+        self._rule_input_values[ioname] = iovalue
+        rules = self.rule_map.get(ioname)
+        if last is None or bool(last) == bool(iovalue) or rules is None or self._stopped:
+            return
+        edge = 'rising' if iovalue else 'falling'
+        for rule in rules:
+            if rule.edge == edge or rule.edge == 'both':
+                self.apply_rule(rule)
+
+    def apply_rule(self, rule):
+        # Through the same path as MQTT commands, so the state topics and
+        # the z2m group mirror follow; written on the next cycle.
+        logger.info("Rule for %s: %s", rule.input_id, rule.action, extra={'input_id': rule.input_id, 'action': rule.action, 'switches': [s.id for s in rule.switches]})
+        self.metrics.rules_fired += 1
+        with self._pending_lock:
+            if rule.action == 'toggle' and len(rule.switches) > 1:
+                # Like a z2m group: all off if any is on, else all on.
+                state = 'off' if any(self.commanded_value(s) for s in rule.switches) else 'on'
+                self._apply_to_switch_group(rule.switches, state, None)
+            elif rule.action in ('toggle', 'on', 'off'):
+                self._apply_to_switch_group(rule.switches, rule.action, None)
+            else:
+                step = rule.step if rule.action == 'dim_up' else -rule.step
+                for s in rule.switches:
+                    percent = round(min(100.0, max(0.0, self.commanded_value(s) / 2.55 + step)))
+                    self._apply_to_switch_group((s,), str(percent) if percent else 'off', None)
+
+    def mqtt_broadcast_input_state(self, inp, value):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Broadcasting MQTT message", extra={'topic': inp["mqtt_state_topic"], 'input': inp['id'], 'state': value})
+        self.mqtt_publish(inp["mqtt_state_topic"], json.dumps({'state': value}), retain=True)
+
+    def mqtt_publish(self, topic, payload, retain=False):
+        with self._publish_lock:
+            if self.publish_dedup and self._last_published.get(topic) == payload:
+                # Also cancels a trailing publish that would undo it.
+                self._publish_deferred.pop(topic, None)
+                self.metrics.publishes_suppressed += 1
+                return
+
+            if self.publish_min_interval:
+                now = time.monotonic()
+                last = self._publish_times.get(topic)
+                if last is not None and now - last < self.publish_min_interval:
+                    self._publish_deferred[topic] = (payload, retain, last + self.publish_min_interval)
+                    self.metrics.publishes_deferred += 1
+                    return
+                self._publish_times[topic] = now
+                self._publish_deferred.pop(topic, None)
+
+            self._last_published[topic] = payload
+            self._send(topic, payload, retain)
+
+    def _publish_trailing(self):
+        # One scan per cycle instead of a timer per deferred topic.
+        with self._publish_lock:
+            now = time.monotonic()
+            for topic in [topic for topic, (payload, retain, due) in self._publish_deferred.items() if due <= now]:
+                payload, retain, due = self._publish_deferred.pop(topic)
+                self._publish_times[topic] = now
+                self._last_published[topic] = payload
+                self._send(topic, payload, retain)
+
+    def _send(self, topic, payload, retain):
+        # With _publish_lock held. paho would queue publishes made while
+        # disconnected without bound; the outbox keeps only the latest per
+        # topic.
+        if not self._mqtt_connected:
+            self._outbox_put(topic, payload, retain)
+            return
+        if self._outbox:
+            # Newer than what the outbox still has to send.
+            self._outbox_pop(topic)
+        self.metrics.publishes += 1
+        self.mqttclient.publish(topic, payload=payload, qos=0, retain=retain)
+
+    def _outbox_put(self, topic, payload, retain):
+        self._outbox_pop(topic)
+        self._outbox[topic] = (payload, retain)
+        self._outbox_bytes += len(topic) + len(payload)
+        if self._outbox_bytes <= self.outbox_max_bytes:
+            return
+        # Over the cap: drop transient messages first, then the oldest
+        # retained ones.
+        dropped = 0
+        for retained in (False, True):
+            for old_topic in [t for t, (p, r) in self._outbox.items() if r == retained]:
+                if self._outbox_bytes <= self.outbox_max_bytes:
+                    break
+                self._outbox_pop(old_topic)
+                dropped += 1
+        self.metrics.outbox_dropped += dropped
+        if not self._outbox_overflowed:
+            self._outbox_overflowed = True
+            logger.warning("Offline outbox full, dropping messages", extra={'max_bytes': self.outbox_max_bytes, 'dropped': dropped})
+
+    def _outbox_pop(self, topic):
+        entry = self._outbox.pop(topic, None)
+        if entry is not None:
+            self._outbox_bytes -= len(topic) + len(entry[0])
+        return entry
+
+    def _flush_outbox(self):
+        # A slice per tick, so a long outage does not end in a burst that
+        # floods the socket and the broker.
+        with self._publish_lock:
+            if self._mqtt_connected:
+                for _ in range(min(max(1, int(self.outbox_flush_rate * OUTBOX_FLUSH_TICK)), len(self._outbox))):
+                    topic = next(iter(self._outbox))
+                    payload, retain = self._outbox_pop(topic)
+                    self._last_published[topic] = payload
+                    self.metrics.publishes += 1
+                    self.mqttclient.publish(topic, payload=payload, qos=0, retain=retain)
+            if not self._mqtt_connected or not self._outbox:
+                # Reconnecting starts a new flush for what is left.
+                self._outbox_flushing = False
+                return
+        self.call_later(OUTBOX_FLUSH_TICK, self._flush_outbox)
 
-        if self.rpi.io[switch["output_id"]].value != new_value:
-            logger.info(f"Setting {switch['name']} ({switch['output_id']}) to {str(state)}")
-            self.rpi.io[switch["output_id"]].value = new_value
+    def forget_published(self, topics):
+        # Make the next publish on these topics go out even if unchanged.
+        with self._publish_lock:
+            for topic in topics:
+                self._last_published.pop(topic, None)
 
     def mqtt_broadcast_switch_availability(self, switch, value):
-       logger.debug("Broadcasting MQTT message on topic: " + switch["mqtt_availability_topic"] + ", value: " + value)
-       self.mqttclient.publish(switch["mqtt_availability_topic"], payload=value, qos=0, retain=True)
+       if logger.isEnabledFor(logging.DEBUG):
+           logger.debug("Broadcasting MQTT message", extra={'topic': switch.mqtt_availability_topic, 'switch': switch.id, 'payload': value})
+       self.mqtt_publish(switch.mqtt_availability_topic, value, retain=True)
 
     def mqtt_broadcast_state(self, switch, state):
-        logger.debug("Broadcasting MQTT message on topic: " + switch["mqtt_state_topic"] + ", value: " + state)
-        self.mqttclient.publish(switch["mqtt_state_topic"], payload=state, qos=0, retain=True)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Broadcasting MQTT message", extra={'topic': switch.mqtt_state_topic, 'switch': switch.id, 'state': state})
+        self.mqtt_publish(switch.mqtt_state_topic, state, retain=True)
 
 if __name__ == "__main__":
     mqttLightControl =  MqttLightControl()